@@ -1,17 +1,123 @@
+import array
 import asyncio
 import subprocess
-from bleak import BleakScanner, BleakClient
+from bleak import BleakScanner, BleakClient, BLEDevice
 import paho.mqtt.client as paho
 import json
+import bisect
+import collections
+import contextlib
 import functools
+import heapq
+import itertools
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+# Optional encoders for the binary MQTT payload formats
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# D-Bus access to BlueZ for the adapter checks (dbus_fast is installed with bleak on Linux); hciconfig otherwise
+try:
+    from dbus_fast import BusType, Message, MessageType, Variant
+    from dbus_fast.aio import MessageBus
+except ImportError:
+    MessageBus = None
+
+# Optional vectorized evaluation of the alert rules
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# TOML configuration files need Python 3.11+; component configuration and the IPC publishing backend need the
+# AWS IoT Device SDK (awsiotsdk)
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+try:
+    from awsiot.greengrasscoreipc.clientv2 import GreengrassCoreIPCClientV2
+    from awsiot.greengrasscoreipc.model import QOS, BinaryMessage, PublishMessage
+except ImportError:
+    GreengrassCoreIPCClientV2 = None
 
 
 # Runtime in Seconds
 RUNTIME = 6000
 
-# Interval at which a BLE Scan is run for devices with correct UUID
+# Interval in seconds of the main cycle (sample rate reports)
 SCAN_INTERVAL = 60
 
+# Seconds without advertisements or notifications after which a device is dropped from the registry
+DEVICE_EXPIRY = 120
+
+# BLE scanning mode for the background scanner: "active" or "passive" (passive needs BlueZ advertisement monitor support)
+SCANNING_MODE = "active"
+
+# Maximum number of simultaneous BLE connections per adapter (match the controller's limit)
+MAX_CONNECTIONS = 5
+
+# Local HCI adapters to use, e.g. ["hci0", "hci1"]; None uses every adapter found in /sys/class/bluetooth.
+# The first adapter runs the background scan; connections prefer the others while they have capacity.
+ADAPTERS = None
+
+# Seconds between reads of the device objects BlueZ keeps under each adapter (0 disables). They give the RSSI
+# of devices on the adapters other than the scan adapter, and let those adapters connect without a scan.
+BLUEZ_REFRESH_INTERVAL = 10
+
+# Sharded mode: number of BLE worker processes (0 runs everything in this process). Devices are split between
+# the workers by a hash of their address; each worker scans, connects, decodes and batches its share of the
+# devices and hands the encoded messages to this process, which only publishes them. MAX_CONNECTIONS per
+# adapter is divided between the workers.
+WORKER_PROCESSES = 0
+WORKER_QUEUE_SIZE = 1000          # Encoded messages in flight from the workers to the publishing process
+WORKER_RESTART_BACKOFF_MAX = 60   # Upper bound in seconds of the delay before a crashed worker is restarted
+
+# Time in seconds a device is listened to on each connection (in adaptive polling, only on the first one)
+LISTEN_WINDOW = 10
+
+# Keep connections open and stream notifications instead of polling devices
+PERSISTENT_CONNECTIONS = True
+
+# With more devices than connection slots, a persistent connection held for this many seconds is closed to make
+# way for a device that waited as long for a slot, so that every device is served in turn. 0 never rotates:
+# devices beyond MAX_CONNECTIONS per adapter then wait until a connection ends.
+STREAM_ROTATE_INTERVAL = 30
+
+# Adaptive polling (PERSISTENT_CONNECTIONS = False): each device gets its own listen window and poll interval,
+# derived from its notification rate, how often its readings change, its RSSI and connection failures.
+POLL_LISTEN_MIN = 2       # Listen window bounds in seconds
+POLL_LISTEN_MAX = 30
+POLL_INTERVAL_MIN = 5     # Bounds in seconds between the end of one poll and the start of the next
+POLL_INTERVAL_MAX = 300
+POLL_SAMPLES = 20         # Notifications a listen window should capture
+POLL_CHANGES = 5          # Reading changes a device may make unobserved between two polls
+# Maximum seconds between polls of devices exposing a characteristic (keys of CHARACTERISTIC_UUIDS)
+LATENCY_BUDGETS = {"ACCELEROMETER_EVENT": 30}
+
+# Reconnect backoff bounds in seconds for persistent connections
+RECONNECT_BACKOFF_MIN = 1
+RECONNECT_BACKOFF_MAX = 60
+
 # ST Manufacturer ID https://www.bluetooth.com/specifications/assigned-numbers/
 STMICROELECTRONICS_MANUFACTURER_KEY = 0x30
 
@@ -23,6 +129,50 @@ CHARACTERISTIC_UUIDS = {
     "SWITCH": "20000000-0001-11e1-ac36-0002a5d5c51b"
 }
 
+# Timestamp reconstruction: readings get an absolute "time" (Unix seconds) from the device's 16-bit "timestamp"
+# counter, unwrapped and fitted against the gateway's clock per device to correct its offset and drift (see DeviceClock).
+# Readings without a counter get their arrival time.
+TIMESTAMP_TICK = 0.008          # Nominal seconds per counter tick (BlueST firmware sends the HAL millisecond tick / 8)
+TIMESTAMP_MAX_DRIFT = 0.05      # Maximum relative deviation of the fitted tick from TIMESTAMP_TICK
+TIMESTAMP_WINDOW = 120          # Samples, at most one per second, the fit is computed over
+TIMESTAMP_RESET_ERROR = 5       # Seconds of disagreement with the fit after which the device is assumed to have restarted
+
+# Edge processing per characteristic (keys of CHARACTERISTIC_UUIDS); characteristics not listed are published raw.
+#   "deadband": {field: threshold}  publish only when a field moved by more than threshold since the last published reading
+#   "on_change": [field, ...]       publish only when one of the fields changed since the last published reading
+#   "heartbeat": seconds            publish at least this often even if nothing changed
+#   "window": seconds               publish count/min/max/mean of numeric fields per window instead of raw readings
+STREAM_PROCESSING = {
+    "BATTERY": {"deadband": {"battery": 1.0, "voltage": 0.05, "current": 1.0}, "on_change": ["status"], "heartbeat": 600},
+    "SWITCH": {"on_change": ["switch"]},
+}
+
+# Edge alerting: rules evaluated on the decoded readings of all devices (vectorized if numpy is installed). Alerts are
+# published right away as JSON to ALERT_TOPIC/<rule name>, without batching, when a rule starts or stops failing.
+#   {"type": "threshold", "field": f, "min": x, "max": y}            f outside [x, y]
+#   {"type": "rate", "field": f, "min_rate": x, "max_rate": y}       f changing slower than x or faster than y per second
+#   {"type": "zscore", "field": f, "window": n, "max_z": z}          f more than z standard deviations from the mean of
+#                                                                    the n readings before it (n from 2 to 4096)
+# e.g. {"overheating": {"type": "threshold", "field": "temperature", "max": 60}}
+ALERT_RULES = {}
+ALERT_TOPIC = "ble_gateway/alerts"
+ALERT_INTERVAL = 0.1    # Minimum seconds between evaluations
+ALERT_HOLDOFF = 300     # Seconds after an alert was raised before it is reported again for the same device
+
+# Logging: level name, and rate limit for repeated warnings/errors (per message template)
+LOG_LEVEL = "INFO"  # "DEBUG" also logs every notification and published reading
+LOG_RATE_LIMIT = 10     # Messages per template ...
+LOG_RATE_INTERVAL = 60  # ... per this many seconds
+
+# Metrics: Prometheus text endpoint on http://METRICS_HOST:METRICS_PORT/metrics (port 0 disables it).
+# In sharded mode worker N serves its own metrics on METRICS_PORT + N + 1 and publishes to METRICS_TOPIC/workerN.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9105
+# Metrics snapshot published to METRICS_TOPIC every METRICS_INTERVAL seconds. Off (0) by default: each snapshot is an
+# IoT Core message, and the device's IoT policy must allow iot:Publish on the topic (see readme).
+METRICS_TOPIC = "ble_gateway/metrics"
+METRICS_INTERVAL = 0
+
 # Path to the certificates
 DEVICE_CERT = "/home/root/certs/certificate.pem"
 DEVICE_KEY = "/home/root/certs/private.key"
@@ -31,68 +181,2395 @@ ROOT_CA = "/home/root/certs/AmazonRootCA1.pem"
 # AWS IoT Endpoint
 ENDPOINT = "a1qwhobjtvew8t-ats.iot.us-west-2.amazonaws.com"
 
-class MqttPublisher:
-    def __init__(self, device_cert, device_key, root_ca, mqtt_endpoint):
+# Publishing backend: "mqtt" connects to ENDPOINT with the certificates above; "ipc" publishes through the Greengrass
+# nucleus over IPC (needs awsiotsdk), which relays to AWS IoT Core and spools messages itself while offline.
+PUBLISH_BACKEND = "mqtt"
+IPC_DESTINATION = "iot_core"   # "iot_core" (relayed by the nucleus) or "local" (local publish/subscribe for other components)
+IPC_MAX_IN_FLIGHT = 100        # Messages awaiting the nucleus' acknowledgement before publishing waits
+
+# Publishing pipeline: readings are batched per topic and flushed by size or age
+PUBLISH_BATCH_SIZE = 20        # Readings per MQTT message (at most 65535)
+PUBLISH_FLUSH_INTERVAL = 5     # Maximum seconds a reading waits in a batch
+PUBLISH_QUEUE_SIZE = 1000      # Readings buffered before the overflow policy applies
+PUBLISH_OVERFLOW_POLICY = "drop_oldest"  # "drop_oldest" or "drop_newest"
+
+# Wire format of published batches: "json", "packed" (columnar, no dependencies), "msgpack" or "cbor"
+# Binary formats start with a 4-byte header; see tools/payload_decoder.py for the reference decoder.
+PAYLOAD_FORMAT = "json"
+
+# Store-and-forward buffer used while the uplink is down (relative paths are inside the component's work directory)
+BUFFER_DIR = "store_and_forward"
+BUFFER_SEGMENT_BYTES = 1024 * 1024      # Size at which a segment is sealed and a new one started
+BUFFER_MAX_BYTES = 64 * 1024 * 1024     # Oldest segments are discarded beyond this size
+BUFFER_DRAIN_RATE = 50                  # Buffered messages re-published per second once back online
+MQTT_MAX_QUEUED_MESSAGES = 100          # Messages paho may hold in memory before the buffer is used (at least 1)
+
+# Local reading history: the last HISTORY_SIZE samples of every numeric field per device (0 disables it), served on
+# the metrics endpoint under /history for other components and on-site dashboards (see ReadingHistory).
+HISTORY_SIZE = 1000
+HISTORY_MAX_SERIES = 512        # Series kept (16 bytes per sample each); the least recently updated is dropped beyond
+HISTORY_PERSIST = False         # Keep the history in memory-mapped files in HISTORY_DIR so that it survives restarts
+HISTORY_DIR = "history"
+
+# Snapshot of the device registry, GATT cache and adapter state, so that a restart reconnects to known devices right
+# away instead of waiting for their advertisements (relative to the component's work directory; interval 0 disables it).
+# In sharded mode worker N uses SNAPSHOT_FILE with ".workerN" before the extension.
+SNAPSHOT_FILE = "gateway_state.json"
+SNAPSHOT_INTERVAL = 30      # Seconds between snapshots; one is also written at shutdown
+SNAPSHOT_MAX_AGE = 3600     # Snapshots older than this many seconds only restore the GATT cache
+
+# Runtime configuration: the constants above (see CONFIG_SCHEMA) can be overridden without a redeployment by the
+# component configuration (Greengrass IPC, needs awsiotsdk) and by CONFIG_FILE, which overrides both. Changes are
+# validated and applied while running; only the affected parts of the gateway restart.
+CONFIG_FILE = "gateway.toml"    # TOML, or JSON if the name ends in .json; relative to the component's work directory
+CONFIG_POLL_INTERVAL = 5        # Seconds between checks of CONFIG_FILE for changes
+
+logger = logging.getLogger("BleGateway")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `limit` warnings/errors with the same message template through per `interval`
+    seconds and reports how many were suppressed once the interval is over.
+    """
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # message template -> [window start, emitted, suppressed]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        now = time.monotonic()
+        window = self.windows.get(record.msg)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            self.windows[record.msg] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            return True
+        if window[1] < self.limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, label_values)) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}  # label values tuple -> count
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in self.values.items()]
+
+    def snapshot(self):
+        return {",".join(map(str, labels)) or "total": value for labels, value in self.values.items()}
+
+
+class Gauge:
+    """Value read from a callback when the metrics are collected."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        return [f"{self.name} {self.read()}"]
+
+    def snapshot(self):
+        return self.read()
+
+
+class Histogram:
+    """Fixed-bucket histogram, optionally split by label values; observations are O(log buckets)."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self.series = {}  # label values tuple -> [count per bucket..., count above last bucket, sum, count]
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def quantile(self, series, q):
+        """Estimates a quantile as the upper bound of the bucket that contains it."""
+        target = q * series[-1]
+        cumulative = 0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = []
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+    def snapshot(self):
+        return {",".join(map(str, labels)) or "total": {"count": series[-1], "sum": series[-2],
+                                                         "p50": self.quantile(series, 0.5), "p99": self.quantile(series, 0.99)}
+                for labels, series in self.series.items()}
+
+
+class MetricsRegistry:
+    """Named metrics of the gateway, rendered as Prometheus text or as a JSON-friendly snapshot."""
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, read):
+        return self.register(Gauge(name, help_text, read))
+
+    def histogram(self, name, help_text, buckets, label_names=()):
+        return self.register(Histogram(name, help_text, buckets, label_names))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DECODE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+
+METRICS = MetricsRegistry()
+SCAN_DURATION = METRICS.histogram("ble_scan_duration_seconds", "Duration of one-shot BLE scans", LATENCY_BUCKETS)
+ADVERTISEMENTS = METRICS.counter("ble_advertisements_total", "Advertisements received by the background scanner")
+CONNECT_LATENCY = METRICS.histogram("ble_connect_latency_seconds", "Time to connect to a device", LATENCY_BUCKETS)
+CONNECT_FAILURES = METRICS.counter("ble_connect_failures_total", "Failed or lost device connections", ("address",))
+NOTIFICATIONS = METRICS.counter("ble_notifications_total", "Notifications received", ("address", "characteristic"))
+DECODE_TIME = METRICS.histogram("ble_decode_seconds", "Time to decode and process one notification", DECODE_BUCKETS)
+READINGS_DROPPED = METRICS.counter("publish_readings_dropped_total", "Readings dropped because the publish queue was full")
+MESSAGES_PUBLISHED = METRICS.counter("mqtt_messages_published_total", "MQTT messages handed to the broker connection")
+MESSAGES_BUFFERED = METRICS.counter("mqtt_messages_buffered_total", "MQTT messages written to the store-and-forward buffer")
+PUBLISH_ACK_LATENCY = METRICS.histogram("mqtt_publish_ack_seconds", "Time from publish to broker acknowledgement", LATENCY_BUCKETS)
+PUBLISH_FAILURES = METRICS.counter("publish_failures_total", "Messages the publishing backend reported as failed")
+WORKER_MESSAGES_DROPPED = METRICS.counter("worker_messages_dropped_total", "Messages dropped because the queue to the publishing process was full")
+ALERTS = METRICS.counter("alerts_total", "Alerts raised and cleared", ("rule", "state"))
+WORKER_RESTARTS = METRICS.counter("worker_restarts_total", "Worker processes restarted after exiting", ("shard",))
+
+
+class LocalHttpServer:
+    """
+    Minimal asyncio HTTP server for local GET endpoints.
+
+    Handlers are registered per path and called with the parsed query string (dict of str -> str);
+    they return (status code, content type, body).
+    """
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.server = None
+
+    def add_route(self, path, handler):
+        self.routes[path] = handler
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode(errors="replace").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+            if len(request_line) < 2 or request_line[0] != "GET":
+                status, content_type, body = 400, "text/plain", "Only GET is supported\n"
+            else:
+                url = urllib.parse.urlsplit(request_line[1])
+                handler = self.routes.get(url.path)
+                if handler is None:
+                    status, content_type, body = 404, "text/plain", "Not found\n"
+                else:
+                    try:
+                        status, content_type, body = handler(dict(urllib.parse.parse_qsl(url.query)))
+                    except Exception as e:
+                        logger.error("Error serving %s: %s", url.path, e)
+                        status, content_type, body = 500, "text/plain", f"{e}\n"
+            body = body.encode() if isinstance(body, str) else body
+            writer.write(f"HTTP/1.0 {status} {self.REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info("Local HTTP endpoint listening on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class MetricsReporter:
+    """Publishes a JSON snapshot of the metrics, with per-second counter rates, at a fixed interval."""
+    def __init__(self, publisher, topic=METRICS_TOPIC, interval=METRICS_INTERVAL, registry=METRICS):
+        self.publisher = publisher
+        self.topic = topic
+        self.interval = interval
+        self.registry = registry
+        self.previous = {}  # counter name -> previous snapshot
+
+    def report(self):
+        snapshot = self.registry.snapshot()
+        rates = {}
+        for name, metric in self.registry.metrics.items():
+            if isinstance(metric, Counter):
+                previous = self.previous.get(name, {})
+                rates[name] = {key: (value - previous.get(key, 0)) / self.interval for key, value in snapshot[name].items()}
+                self.previous[name] = snapshot[name]
+        return {"time": time.time(), "metrics": snapshot, "rates": rates}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.publisher.publish_message(self.topic, json.dumps(self.report()))
+            except Exception as e:
+                logger.error("Error publishing metrics: %s", e)
+
+
+class CharacteristicDecoder:
+    """
+    Declarative description of a characteristic's notification payload.
+
+    Args:
+        stream (str): Topic segment the readings are published under, e.g. "temp".
+        layout (str): struct format of the payload, compiled once.
+        fields (tuple): One (field_name, scale) pair per value in `layout`. A field_name of None
+            drops the value; a scale of None keeps the raw integer.
+        maps (dict): Optional field_name -> {raw value: label} lookups; unknown values map to "Unknown".
+        skip_first (bool): Ignore the first notification after each (re)connection.
+    """
+    def __init__(self, stream, layout, fields, maps=None, skip_first=False):
+        self.stream = stream
+        self.struct = struct.Struct(layout)
+        self.skip_first = skip_first
+        maps = maps or {}
+        # (field_name, scale, map) per kept value, in payload order
+        self.plan = tuple((index, name, scale, maps.get(name)) for index, (name, scale) in enumerate(fields) if name is not None)
+
+    def decode(self, data):
+        """Decodes a notification payload (bytes, bytearray or memoryview) into a dict of fields."""
+        values = self.struct.unpack_from(data)
+        reading = {}
+        for index, name, scale, mapping in self.plan:
+            value = values[index]
+            if mapping is not None:
+                reading[name] = mapping.get(value, "Unknown")
+            elif scale is not None:
+                reading[name] = value / scale
+            else:
+                reading[name] = value
+        return reading
+
+
+# Payload layouts of the PROTEUS (BlueST) characteristics, keyed by the names used in CHARACTERISTIC_UUIDS.
+# New characteristics only need a UUID in CHARACTERISTIC_UUIDS and an entry here.
+CHARACTERISTIC_DECODERS = {
+    "TEMPERATURE": CharacteristicDecoder(
+        "temp", "<HH",
+        (("timestamp", None), ("temperature", 10.0)),
+        skip_first=True),
+    "BATTERY": CharacteristicDecoder(
+        "battery", "<HHHHB",
+        (("timestamp", None), ("battery", 10.0), ("voltage", 1000.0), ("current", 10.0), ("status", None)),
+        maps={"status": {
+            0: "Low battery",
+            1: "Discharging",
+            2: "Plugged, not charging",
+            3: "Charging",
+            4: "Unknown"
+        }}),
+    "ACCELEROMETER_EVENT": CharacteristicDecoder(
+        "acc_event", "<HBH",
+        (("timestamp", None), ("event", None), ("steps", None)),
+        maps={"event": {
+            0: "No event",
+            1: "Orientation top right",
+            2: "Orientation bottom right",
+            3: "Orientation bottom left",
+            4: "Orientation top left",
+            5: "Orientation up",
+            6: "Orientation bottom",
+            8: "Tilt",
+            16: "Free fall",
+            32: "Single tap",
+            64: "Double tap",
+            128: "Wake up"
+        }}),
+    "SWITCH": CharacteristicDecoder(
+        "switch", "<HB",
+        (("timestamp", None), ("switch", None)),
+        maps={"switch": {
+            0: "OFF",
+            1: "ON"
+        }}),
+}
+
+
+class DeviceClock:
+    """
+    Maps a device's 16-bit timestamp counter to the gateway's monotonic clock.
+
+    Counter values are unwrapped to the wrap closest to what the current fit predicts from the
+    arrival time, so long gaps between connections and out-of-order notifications are handled.
+    Offset and tick duration (drift) are a least-squares fit of the unwrapped counter against
+    arrival times over up to TIMESTAMP_WINDOW samples, one per SAMPLE_PERIOD seconds; the tick
+    duration starts at TIMESTAMP_TICK and stays within TIMESTAMP_MAX_DRIFT of it. A counter that
+    disagrees with the fit by more than TIMESTAMP_RESET_ERROR seconds (the device restarted)
+    starts a new fit.
+    """
+    WRAP = 65536
+    SAMPLE_PERIOD = 1
+    MIN_SPAN = 30  # Seconds of samples needed before the tick duration is fitted
+
+    def __init__(self, tick=None, window=None, max_drift=None, reset_error=None):
+        self.nominal_tick = tick or TIMESTAMP_TICK
+        self.max_drift = TIMESTAMP_MAX_DRIFT if max_drift is None else max_drift
+        self.reset_error = reset_error or TIMESTAMP_RESET_ERROR
+        self.samples = collections.deque(maxlen=window or TIMESTAMP_WINDOW)  # (unwrapped ticks, arrival)
+        self.tick = self.nominal_tick
+        self.origin = None  # (ticks, arrival) the fitted line goes through
+        self.resets = 0
+
+    def restart(self, ticks, arrival):
+        self.samples.clear()
+        self.samples.append((ticks, arrival))
+        self.tick = self.nominal_tick
+        self.origin = (ticks, arrival)
+
+    def fit(self):
+        first_ticks, first_arrival = self.samples[0]
+        count = len(self.samples)
+        mean_ticks = sum(ticks - first_ticks for ticks, _ in self.samples) / count
+        mean_arrival = sum(arrival - first_arrival for _, arrival in self.samples) / count
+        self.origin = (first_ticks + mean_ticks, first_arrival + mean_arrival)
+        if self.samples[-1][1] - first_arrival < self.MIN_SPAN:
+            return
+        sxx = sxy = 0.0
+        for ticks, arrival in self.samples:
+            dx = ticks - first_ticks - mean_ticks
+            sxx += dx * dx
+            sxy += dx * (arrival - first_arrival - mean_arrival)
+        if sxx > 0:
+            low, high = self.nominal_tick * (1 - self.max_drift), self.nominal_tick * (1 + self.max_drift)
+            self.tick = min(high, max(low, sxy / sxx))
+
+    def align(self, counter, arrival):
+        """Records a counter value received at monotonic time `arrival` and returns its corrected monotonic time."""
+        if self.origin is None:
+            self.restart(counter, arrival)
+            return arrival
+        origin_ticks, origin_arrival = self.origin
+        expected = origin_ticks + (arrival - origin_arrival) / self.tick
+        ticks = counter + round((expected - counter) / self.WRAP) * self.WRAP
+        corrected = origin_arrival + (ticks - origin_ticks) * self.tick
+        if abs(corrected - arrival) > self.reset_error:
+            self.resets += 1
+            self.restart(counter, arrival)
+            return arrival
+        if arrival - self.samples[-1][1] >= self.SAMPLE_PERIOD:
+            self.samples.append((ticks, arrival))
+            self.fit()
+        return corrected
+
+
+class ClockAligner:
+    """
+    Per-device DeviceClocks that turn the timestamp counter of readings into absolute Unix times,
+    so readings of many devices can be merged and ordered downstream. Clocks of expired devices are dropped.
+    """
+    def __init__(self):
+        self.clocks = {}  # device_address -> DeviceClock
+
+    def time(self, device_address, counter, arrival):
+        """Returns the Unix time of a reading with timestamp `counter` received at monotonic time `arrival`."""
+        clock = self.clocks.get(device_address)
+        if clock is None:
+            clock = self.clocks[device_address] = DeviceClock()
+        return clock.align(counter, arrival) + time.time() - time.monotonic()
+
+    def on_registry_event(self, event, entry):
+        if event == "expire":
+            self.clocks.pop(entry.address, None)
+
+
+class StreamRule:
+    """
+    Deadband, report-on-change and windowed aggregation for one characteristic, with O(1) state per device.
+
+    Without a window, a reading is published if it is the first from the device, if the heartbeat
+    elapsed, if an `on_change` field differs or if a `deadband` field moved by more than its threshold
+    since the last published reading. With a window, numeric fields are aggregated per device and one
+    count/min/max/mean message is published per window, with the times of its first and last reading.
+    """
+    SKIPPED_FIELDS = ("device", "address", "timestamp", "time")
+
+    def __init__(self, deadband=None, on_change=None, heartbeat=None, window=None):
+        self.deadband = dict(deadband or {})
+        self.on_change = tuple(on_change or ())
+        self.heartbeat = heartbeat
+        self.window = window
+        self.last_published = {}  # device_address -> (time, message)
+        self.windows = {}  # device_address -> [topic, device_name, start time, count, {field: [min, max, sum]}, first time, last time]
+
+    def should_publish(self, device_address, message, now):
+        last = self.last_published.get(device_address)
+        if last is None:
+            return True
+        last_time, last_message = last
+        if self.heartbeat is not None and now - last_time >= self.heartbeat:
+            return True
+        for field in self.on_change:
+            if message.get(field) != last_message.get(field):
+                return True
+        for field, threshold in self.deadband.items():
+            value, previous = message.get(field), last_message.get(field)
+            if value is None or previous is None:
+                if value is not previous:
+                    return True
+            elif abs(value - previous) > threshold:
+                return True
+        return not self.on_change and not self.deadband
+
+    def process(self, topic, message, now, submit):
+        """Applies the rule to a reading, calling submit(topic, message) for everything to publish."""
+        device_address = message["address"]
+        if self.window is None:
+            if self.should_publish(device_address, message, now):
+                self.last_published[device_address] = (now, message)
+                submit(topic, message)
+            return
+
+        state = self.windows.get(device_address)
+        if state is not None and now - state[2] >= self.window:
+            submit(*self.summarize(device_address, self.windows.pop(device_address)))
+            state = None
+        if state is None:
+            state = self.windows[device_address] = [topic, message["device"], now, 0, {}, message.get("time"), None]
+        state[3] += 1
+        state[6] = message.get("time")
+        stats = state[4]
+        for field, value in message.items():
+            if field in self.SKIPPED_FIELDS or isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            field_stats = stats.get(field)
+            if field_stats is None:
+                stats[field] = [value, value, value]
+            else:
+                if value < field_stats[0]:
+                    field_stats[0] = value
+                if value > field_stats[1]:
+                    field_stats[1] = value
+                field_stats[2] += value
+
+    def summarize(self, device_address, state):
+        """Builds the (topic, message) aggregate of a closed window."""
+        topic, device_name, _, count, stats, first_time, last_time = state
+        message = {"device": device_name, "address": device_address, "window": self.window, "count": count}
+        if first_time is not None:
+            message["time"] = first_time
+            message["time_end"] = last_time
+        for field, (low, high, total) in stats.items():
+            message[f"{field}_min"] = low
+            message[f"{field}_max"] = high
+            message[f"{field}_mean"] = total / count
+        return topic, message
+
+    def flush_expired(self, now, submit):
+        """Publishes the aggregates of windows that ended without a new reading to close them."""
+        if self.window is None:
+            return
+        for device_address in [address for address, state in self.windows.items() if now - state[2] >= self.window]:
+            submit(*self.summarize(device_address, self.windows.pop(device_address)))
+
+
+class StreamProcessor:
+    """Holds the StreamRule of each configured characteristic and closes expired windows periodically."""
+    def __init__(self, config, submit):
+        self.submit = submit
+        self.rules = {name: StreamRule(**options) for name, options in config.items()}
+
+    def configure(self, config):
+        """Replaces the rules, first publishing the aggregates of the current rules' open windows."""
+        for rule in self.rules.values():
+            rule.flush_expired(float("inf"), self.submit)
+        self.rules = {name: StreamRule(**options) for name, options in config.items()}
+
+    async def run(self, period=1):
+        """Flushes expired aggregation windows every `period` seconds until cancelled."""
+        try:
+            while True:
+                await asyncio.sleep(period)
+                now = time.monotonic()
+                for rule in self.rules.values():
+                    rule.flush_expired(now, self.submit)
+        except asyncio.CancelledError:
+            for rule in self.rules.values():
+                rule.flush_expired(float("inf"), self.submit)
+            raise
+
+
+class AlertRule:
+    """
+    One edge alert rule on a reading field (see ALERT_RULES).
+
+    test() is written with operators that work elementwise on numpy arrays, so it evaluates all
+    devices at once when numpy is installed, and on the scalars of one device otherwise.
+    """
+    TYPES = ("threshold", "rate", "zscore")
+    MAX_WINDOW = 4096  # Bounds the memory of the windows, which keep this many readings per device
+    OPTIONS = {"threshold": ("min", "max"), "rate": ("min_rate", "max_rate"), "zscore": ("window", "max_z")}
+
+    def __init__(self, name, options):
+        self.name = name
+        self.type = options.get("type")
+        if self.type not in self.TYPES:
+            raise ValueError(f"type: expected one of {', '.join(self.TYPES)}, got {self.type!r}")
+        self.field = options.get("field")
+        if not isinstance(self.field, str) or not self.field:
+            raise ValueError(f"field: expected a field name, got {self.field!r}")
+        unknown = set(options) - {"type", "field"} - set(self.OPTIONS[self.type])
+        if unknown:
+            raise ValueError(f"unknown options for a {self.type} rule: {', '.join(sorted(unknown))}")
+        number = config_number()
+        self.minimum = number(options["min"]) if "min" in options else -math.inf
+        self.maximum = number(options["max"]) if "max" in options else math.inf
+        self.min_rate = number(options["min_rate"]) if "min_rate" in options else -math.inf
+        self.max_rate = number(options["max_rate"]) if "max_rate" in options else math.inf
+        self.max_z = config_number(minimum=0)(options.get("max_z", 3))
+        # Readings before the latest one its mean and standard deviation are computed over
+        self.history = config_number(minimum=2, maximum=self.MAX_WINDOW, integer=True)(options.get("window", 60)) if self.type == "zscore" else 0
+
+    def test(self, latest, previous, dt, mean, std):
+        """True where the latest reading violates the rule; NaN inputs (not enough readings) never do."""
+        if self.type == "threshold":
+            return (latest < self.minimum) | (latest > self.maximum)
+        if self.type == "rate":
+            change = latest - previous
+            return (dt > 0) & ((change < self.min_rate * dt) | (change > self.max_rate * dt))
+        return (std > 0) & (abs(latest - mean) > self.max_z * std)
+
+    def details(self, latest, previous, dt, mean, std):
+        """Rule-specific values included in an alert."""
+        if self.type == "threshold":
+            return {bound: value for bound, value in (("min", self.minimum), ("max", self.maximum)) if math.isfinite(value)}
+        if self.type == "rate":
+            return {"rate": (latest - previous) / dt}
+        return {"mean": mean, "std": std, "zscore": (latest - mean) / std, "window": self.history}
+
+
+class FieldWindow:
+    """
+    The last `size` readings of one field for every device, as rows of a values and a times matrix
+    (numpy arrays if numpy is installed, else one array per row).
+    """
+    def __init__(self, size, rows):
+        self.size = size
+        self.rows = 0
+        if numpy is not None:
+            self.values = numpy.full((0, size), math.nan)
+            self.times = numpy.full((0, size), math.nan)
+            self.count = numpy.zeros(0, dtype=numpy.int64)
+        else:
+            self.values, self.times, self.count = [], [], []
+        self.grow(rows)
+
+    def grow(self, rows):
+        """Adds rows up to `rows`."""
+        added = rows - self.rows
+        if added <= 0:
+            return
+        if numpy is not None:
+            self.values = numpy.vstack((self.values, numpy.full((added, self.size), math.nan)))
+            self.times = numpy.vstack((self.times, numpy.full((added, self.size), math.nan)))
+            self.count = numpy.concatenate((self.count, numpy.zeros(added, dtype=numpy.int64)))
+        else:
+            for _ in range(added):
+                self.values.append(array.array("d", [math.nan]) * self.size)
+                self.times.append(array.array("d", [math.nan]) * self.size)
+                self.count.append(0)
+        self.rows = rows
+
+    def append(self, row, value, timestamp):
+        position = self.count[row] % self.size
+        self.values[row][position] = value
+        self.times[row][position] = timestamp
+        self.count[row] += 1
+
+    def reset(self, row):
+        self.values[row][:] = array.array("d", [math.nan]) * self.size if numpy is None else math.nan
+        self.count[row] = 0
+
+    def columns(self, rows, history):
+        """
+        Returns (latest, previous, dt, mean, std, time) for the given rows: the latest reading, the one
+        before, the time between them, the mean and standard deviation of the `history` readings
+        before the latest (NaN until there are that many) and the time of the latest reading.
+        """
+        if numpy is not None:
+            index = numpy.asarray(rows, dtype=numpy.int64)
+            count = self.count[index]
+            last, before = (count - 1) % self.size, (count - 2) % self.size
+            latest = numpy.where(count >= 1, self.values[index, last], math.nan)
+            latest_time = numpy.where(count >= 1, self.times[index, last], math.nan)
+            previous = numpy.where(count >= 2, self.values[index, before], math.nan)
+            dt = numpy.where(count >= 2, latest_time - self.times[index, before], math.nan)
+            mean = std = numpy.full(len(index), math.nan)
+            if history:
+                past = self.values[index[:, None], (count[:, None] - 2 - numpy.arange(history)) % self.size]
+                full = count > history
+                mean = numpy.where(full, past.mean(axis=1), math.nan)
+                std = numpy.where(full, past.std(axis=1), math.nan)
+            return latest, previous, dt, mean, std, latest_time
+
+        columns = ([], [], [], [], [], [])
+        for row in rows:
+            count, values, times = self.count[row], self.values[row], self.times[row]
+            last, before = (count - 1) % self.size, (count - 2) % self.size
+            mean = std = math.nan
+            if history and count > history:
+                past = [values[(count - 2 - offset) % self.size] for offset in range(history)]
+                mean = sum(past) / history
+                std = math.sqrt(sum((value - mean) ** 2 for value in past) / history)
+            row_columns = (values[last] if count >= 1 else math.nan,
+                           values[before] if count >= 2 else math.nan,
+                           times[last] - times[before] if count >= 2 else math.nan,
+                           mean, std,
+                           times[last] if count >= 1 else math.nan)
+            for column, value in zip(columns, row_columns):
+                column.append(value)
+        return columns
+
+
+class AlertEngine:
+    """
+    Evaluates ALERT_RULES on the decoded readings of all devices and publishes alerts right away,
+    bypassing the batching pipeline, to ALERT_TOPIC/<rule name>.
+
+    Readings are appended to one FieldWindow per field in the rules. At most every ALERT_INTERVAL
+    seconds, each rule is evaluated on the devices with new readings at once (vectorized with numpy
+    if it is installed). An alert is "raised" when a rule starts failing for a device and "cleared"
+    when it passes again; a rule raised within the last ALERT_HOLDOFF seconds for the same device
+    is not reported again.
+    """
+    SETTINGS = ("ALERT_RULES",)
+
+    def __init__(self, rules, publisher):
+        self.publisher = publisher
+        self.rows = {}  # device_address -> row in the field windows
+        self.devices = []  # row -> (device_name, device_address)
+        self.free_rows = []
+        self.capacity = 16
+        self.dirty = set()  # Rows with readings since the last evaluation
+        self.pending = None  # asyncio.Event set on new readings, created in run()
+        self.active = {}  # (rule name, row) -> whether the raised alert was published
+        self.last_raised = {}  # (rule name, device_address) -> time
+        self.configure(rules)
+
+    def configure(self, rules):
+        """Replaces the rules; readings collected so far are discarded."""
+        self.rules = [AlertRule(name, options) for name, options in rules.items()]
+        sizes = {}
+        for rule in self.rules:
+            sizes[rule.field] = max(sizes.get(rule.field, 2), rule.history + 1)
+        self.windows = {field: FieldWindow(size, self.capacity) for field, size in sizes.items()}
+        self.active.clear()
+        self.dirty.clear()
+
+    def reconfigure(self, changes):
+        self.configure(changes["ALERT_RULES"])
+
+    def record(self, device_name, device_address, reading, timestamp):
+        """Appends the fields of a decoded reading that rules apply to."""
+        row = self.rows.get(device_address)
+        for field, window in self.windows.items():
+            value = reading.get(field)
+            if value.__class__ not in (int, float):
+                continue
+            if row is None:
+                row = self.add_row(device_name, device_address)
+            window.append(row, value, timestamp)
+            self.dirty.add(row)
+        if self.dirty and self.pending is not None:
+            self.pending.set()
+
+    def add_row(self, device_name, device_address):
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.devices[row] = (device_name, device_address)
+        else:
+            row = len(self.devices)
+            self.devices.append((device_name, device_address))
+            if row >= self.capacity:
+                self.capacity *= 2
+                for window in self.windows.values():
+                    window.grow(self.capacity)
+        self.rows[device_address] = row
+        return row
+
+    def on_registry_event(self, event, entry):
+        """Frees the row of an expired device; its active alerts are dropped without being cleared."""
+        row = self.rows.pop(entry.address, None) if event == "expire" else None
+        if row is None:
+            return
+        for window in self.windows.values():
+            window.reset(row)
+        for key in [key for key in self.active if key[1] == row]:
+            del self.active[key]
+        self.dirty.discard(row)
+        self.free_rows.append(row)
+
+    def evaluate(self, now=None):
+        """Evaluates the rules on the rows with new readings and returns the (topic, alert) pairs to publish."""
+        now = time.time() if now is None else now
+        rows = sorted(self.dirty)
+        self.dirty.clear()
+        if not rows:
+            return []
+        alerts = []
+        columns_cache = {}
+        for rule in self.rules:
+            key = (rule.field, rule.history)
+            columns = columns_cache.get(key)
+            if columns is None:
+                columns = columns_cache[key] = self.windows[rule.field].columns(rows, rule.history)
+            if numpy is not None:
+                with numpy.errstate(invalid="ignore"):
+                    failing = rule.test(*columns[:5]).tolist()
+            else:
+                failing = [rule.test(*values) for values in zip(*columns[:5])]
+            for position, row in enumerate(rows):
+                alert_key = (rule.name, row)
+                if failing[position] == (alert_key in self.active):
+                    continue
+                device_name, device_address = self.devices[row]
+                values = [float(column[position]) for column in columns]
+                if failing[position]:
+                    published = now - self.last_raised.get((rule.name, device_address), -math.inf) >= ALERT_HOLDOFF
+                    self.active[alert_key] = published
+                    if not published:
+                        continue
+                    self.last_raised[(rule.name, device_address)] = now
+                    state = "raised"
+                elif self.active.pop(alert_key):
+                    state = "cleared"
+                else:
+                    continue
+                alert = {"rule": rule.name, "type": rule.type, "state": state, "device": device_name,
+                         "address": device_address, "field": rule.field, "value": values[0], "time": round(values[5], 3)}
+                if state == "raised":
+                    alert.update(rule.details(*values[:5]))
+                alerts.append((f"{ALERT_TOPIC}/{rule.name}", alert))
+        return alerts
+
+    async def run(self):
+        """Evaluates the rules whenever there are new readings, at most every ALERT_INTERVAL seconds, until cancelled."""
+        self.pending = asyncio.Event()
+        while True:
+            await self.pending.wait()
+            self.pending.clear()
+            for topic, alert in self.evaluate():
+                if alert["state"] == "raised":
+                    logger.warning("Alert %s raised for %s (%s): %s = %s", alert["rule"], alert["device"], alert["address"], alert["field"], alert["value"])
+                ALERTS.inc((alert["rule"], alert["state"]))
+                try:
+                    await self.publisher.publish_message(topic, json.dumps(alert))
+                except Exception as e:
+                    logger.error("Error publishing alert to %s: %s", topic, e)
+            await asyncio.sleep(ALERT_INTERVAL)
+
+
+class StoreAndForwardBuffer:
+    """
+    Disk-backed, append-only segmented log of MQTT messages for offline periods.
+
+    Messages are appended to the newest segment file; a segment is sealed once it reaches
+    `segment_bytes`. Draining reads the oldest segment and records how many of its messages
+    were acknowledged in a sidecar ".ack" file, so a restart resumes where it left off. A fully
+    acknowledged segment is deleted. When the log exceeds `max_bytes`, the oldest segments are
+    discarded to keep disk usage bounded, except the segment being drained.
+    """
+    RECORD_HEADER = struct.Struct("<HI")  # topic length, payload length
+
+    def __init__(self, directory=BUFFER_DIR, segment_bytes=BUFFER_SEGMENT_BYTES, max_bytes=BUFFER_MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.discarded_segments = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg"))
+        self.sizes = {seq: os.path.getsize(self.segment_path(seq)) for seq in self.segments}
+        self.active = None  # Open file of the segment being appended to
+        self.active_seq = None
+        self.draining = None  # Segment returned by oldest_segment() and not acknowledged yet
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:010d}.seg")
+
+    def ack_path(self, seq):
+        return os.path.join(self.directory, f"{seq:010d}.ack")
+
+    def is_empty(self):
+        return not self.segments
+
+    def append(self, topic, payload):
+        """Appends one message to the log."""
+        topic_bytes = topic.encode()
+        payload_bytes = payload.encode() if isinstance(payload, str) else payload
+        if self.active is None:
+            self.active_seq = self.segments[-1] + 1 if self.segments else 0
+            self.active = open(self.segment_path(self.active_seq), "ab")
+            self.segments.append(self.active_seq)
+            self.sizes[self.active_seq] = 0
+
+        record = self.RECORD_HEADER.pack(len(topic_bytes), len(payload_bytes)) + topic_bytes + payload_bytes
+        self.active.write(record)
+        self.active.flush()
+        self.sizes[self.active_seq] += len(record)
+
+        if self.sizes[self.active_seq] >= self.segment_bytes:
+            self.seal()
+        self.enforce_limit()
+
+    def seal(self):
+        """Closes the active segment so it can be drained; the next append starts a new one."""
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+            self.active_seq = None
+
+    def enforce_limit(self):
+        """Discards the oldest segments while the log is larger than `max_bytes`, keeping the newest and the one being drained."""
+        while sum(self.sizes.values()) > self.max_bytes:
+            seq = next((seq for seq in self.segments[:-1] if seq != self.draining), None)
+            if seq is None:
+                break
+            self.remove(seq)
+            self.discarded_segments += 1
+            logger.warning("Store-and-forward buffer full, discarded segment %d (%d so far)", seq, self.discarded_segments)
+
+    def remove(self, seq):
+        if seq in self.sizes:
+            self.segments.remove(seq)
+            del self.sizes[seq]
+        for path in (self.segment_path(seq), self.ack_path(seq)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def acked_count(self, seq):
+        try:
+            with open(self.ack_path(seq)) as ack_file:
+                return int(ack_file.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def oldest_segment(self):
+        """
+        Returns (seq, messages) for the oldest segment, skipping already acknowledged messages.
+        The active segment is sealed first if it is the only one left.
+        """
+        if not self.segments:
+            return None, []
+        seq = self.draining = self.segments[0]
+        if seq == self.active_seq:
+            self.seal()
+
+        with open(self.segment_path(seq), "rb") as segment_file:
+            data = segment_file.read()
+        messages = []
+        offset = 0
+        header_size = self.RECORD_HEADER.size
+        while offset + header_size <= len(data):
+            topic_length, payload_length = self.RECORD_HEADER.unpack_from(data, offset)
+            end = offset + header_size + topic_length + payload_length
+            if end > len(data):
+                break  # Truncated record from an interrupted write
+            topic = data[offset + header_size:offset + header_size + topic_length].decode()
+            messages.append((topic, data[offset + header_size + topic_length:end]))
+            offset = end
+        return seq, messages[self.acked_count(seq):]
+
+    def ack(self, seq, count, complete):
+        """
+        Records that `count` more messages of segment `seq` were acknowledged.
+        A complete segment is deleted; otherwise the new acknowledged count is persisted.
+        Nothing is recorded for a segment that no longer exists.
+        """
+        if seq == self.draining:
+            self.draining = None
+        if seq not in self.sizes:
+            return
+        if complete:
+            self.remove(seq)
+            return
+        tmp_path = self.ack_path(seq) + ".tmp"
+        with open(tmp_path, "w") as ack_file:
+            ack_file.write(str(self.acked_count(seq) + count))
+        os.replace(tmp_path, self.ack_path(seq))
+
+
+class TimeSeries:
+    """
+    Fixed-size ring of (timestamp, value) samples stored in two float64 columns, either in memory
+    or in a memory-mapped file at `path` that keeps the samples across restarts.
+
+    Samples are kept in timestamp order: a timestamp older than the newest sample (e.g. after the
+    clock was stepped back) is stored with the newest timestamp.
+    """
+    HEADER = struct.Struct("<4sIQ16x")  # magic, capacity, samples written since creation; 32 bytes
+    MAGIC = b"BGTS"
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.file = None
+        self.mmap = None
+        self.view = None
+        if path is None:
+            self.written = 0
+            self.timestamps = array.array("d", bytes(8 * capacity))
+            self.values = array.array("d", bytes(8 * capacity))
+        else:
+            self.open_file(path)
+
+    def open_file(self, path):
+        """Maps the series file, (re)initializing it if it does not hold a series of this capacity."""
+        size = self.HEADER.size + 16 * self.capacity
+        self.file = open(path, "a+b")
+        header = b""
+        if os.path.getsize(path) == size:
+            self.file.seek(0)
+            header = self.file.read(self.HEADER.size)
+        if header[:8] != struct.pack("<4sI", self.MAGIC, self.capacity):
+            self.file.truncate(0)
+            self.file.truncate(size)
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.view = memoryview(self.mmap)
+        magic, capacity, self.written = self.HEADER.unpack_from(self.mmap)
+        if magic != self.MAGIC:
+            self.written = 0
+            self.HEADER.pack_into(self.mmap, 0, self.MAGIC, self.capacity, 0)
+        self.timestamps = self.view[self.HEADER.size:self.HEADER.size + 8 * self.capacity].cast("d")
+        self.values = self.view[self.HEADER.size + 8 * self.capacity:].cast("d")
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def newest(self):
+        """Timestamp of the newest sample, or None if the series is empty."""
+        return self.timestamps[(self.written - 1) % self.capacity] if self.written else None
+
+    def append(self, timestamp, value):
+        if self.written:
+            timestamp = max(timestamp, self.timestamps[(self.written - 1) % self.capacity])
+        index = self.written % self.capacity
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        self.written += 1
+        if self.mmap is not None:
+            struct.pack_into("<Q", self.mmap, 8, self.written)
+
+    def sample(self, index):
+        """Returns the (timestamp, value) of the `index`-th oldest sample."""
+        position = (self.written - len(self) + index) % self.capacity
+        return self.timestamps[position], self.values[position]
+
+    def bisect(self, timestamp, right=False):
+        """Index of the first sample newer than (right) or at least as new as `timestamp`."""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            sample_time = self.sample(middle)[0]
+            if sample_time < timestamp or (right and sample_time == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def latest(self, count=1):
+        """Returns the `count` newest samples, oldest first."""
+        return [self.sample(index) for index in range(max(0, len(self) - count), len(self))]
+
+    def range(self, start, end):
+        """Returns the samples with start <= timestamp <= end, oldest first."""
+        return [self.sample(index) for index in range(self.bisect(start), self.bisect(end, right=True))]
+
+    def downsample(self, start, end, step):
+        """Aggregates the samples between start and end into `step`-second buckets of count/min/max/mean."""
+        buckets = []
+        for timestamp, value in self.range(start, end):
+            bucket_start = start + (timestamp - start) // step * step
+            if not buckets or buckets[-1]["time"] != bucket_start:
+                buckets.append({"time": bucket_start, "count": 0, "min": value, "max": value, "sum": 0.0})
+            bucket = buckets[-1]
+            bucket["count"] += 1
+            bucket["min"] = min(bucket["min"], value)
+            bucket["max"] = max(bucket["max"], value)
+            bucket["sum"] += value
+        for bucket in buckets:
+            bucket["mean"] = bucket.pop("sum") / bucket["count"]
+        return buckets
+
+    def close(self):
+        if self.mmap is not None:
+            self.timestamps.release()
+            self.values.release()
+            self.view.release()
+            self.mmap.close()
+            self.file.close()
+            self.mmap = None
+
+
+class ReadingHistory:
+    """
+    Recent readings of the devices for local consumers: one TimeSeries of `size` samples per device
+    address, stream and numeric field, at most `max_series` of them (the least recently updated
+    series is dropped to make room). With a `directory`, the series are memory-mapped files there
+    and are reloaded after a restart.
+
+    routes() returns the query API served on the local HTTP endpoint:
+        /history                               the series, with their sample count and time span
+        /history/latest?address&stream&field&count
+        /history/range?address&stream&field&start&end          (Unix times; defaults: the last hour)
+        /history/downsample?address&stream&field&start&end&step
+    """
+    SUFFIX = ".ts"
+
+    def __init__(self, size, directory=None, max_series=None):
+        self.size = size
+        self.directory = directory
+        self.max_series = max_series or HISTORY_MAX_SERIES
+        self.series = {}  # (address, stream, field) -> TimeSeries
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    def path(self, key):
+        return os.path.join(self.directory, urllib.parse.quote("|".join(key), safe="") + self.SUFFIX)
+
+    def load(self):
+        """Maps the series files of a previous run, the most recently updated ones first."""
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            key = tuple(urllib.parse.unquote(name[:-len(self.SUFFIX)]).split("|"))
+            if len(key) == 3:
+                self.series[key] = TimeSeries(self.size, self.path(key))
+        while len(self.series) > self.max_series:
+            self.evict()
+        if self.series:
+            logger.info("Loaded %d reading history series from %s", len(self.series), self.directory)
+
+    def evict(self):
+        key = min(self.series, key=lambda key: self.series[key].newest() or 0)
+        self.series.pop(key).close()
+        if self.directory is not None:
+            os.remove(self.path(key))
+
+    def record(self, address, stream, reading, timestamp):
+        """Appends the numeric fields of a decoded reading (except the device's own timestamp)."""
+        for field, value in reading.items():
+            if field == "timestamp" or value.__class__ not in (int, float):
+                continue
+            key = (address, stream, field)
+            series = self.series.get(key)
+            if series is None:
+                if len(self.series) >= self.max_series:
+                    self.evict()
+                series = self.series[key] = TimeSeries(self.size, self.path(key) if self.directory is not None else None)
+            series.append(timestamp, value)
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+        self.series = {}
+
+    def routes(self):
+        return {
+            "/history": self.handle_index,
+            "/history/latest": functools.partial(self.handle_query, "latest"),
+            "/history/range": functools.partial(self.handle_query, "range"),
+            "/history/downsample": functools.partial(self.handle_query, "downsample"),
+        }
+
+    def handle_index(self, query):
+        series = [{"address": address, "stream": stream, "field": field, "count": len(samples),
+                   "first": samples.sample(0)[0], "last": samples.newest()}
+                  for (address, stream, field), samples in sorted(self.series.items()) if len(samples)]
+        return 200, "application/json", json.dumps({"series": series})
+
+    def handle_query(self, kind, query):
+        try:
+            key = (query["address"].upper(), query["stream"], query["field"])
+            end = float(query.get("end", time.time()))
+            start = float(query.get("start", end - 3600))
+            count = int(query.get("count", 1))
+            step = float(query.get("step", 60))
+        except KeyError as e:
+            return 400, "text/plain", f"Missing query parameter {e}\n"
+        except ValueError as e:
+            return 400, "text/plain", f"Invalid query parameter: {e}\n"
+        series = self.series.get(key)
+        if series is None:
+            return 404, "text/plain", "No such series\n"
+        if kind == "latest":
+            result = {"samples": series.latest(count)}
+        elif kind == "range":
+            result = {"samples": series.range(start, end)}
+        else:
+            if step <= 0:
+                return 400, "text/plain", "step must be positive\n"
+            result = {"buckets": series.downsample(start, end, step)}
+        return 200, "application/json", json.dumps(result)
+
+
+class Publisher:
+    """
+    Interface of the publishing backends used by the publish pipeline and the metrics reporter.
+
+    publish_message() hands one encoded message to the backend without waiting for the network.
+    Backends with an offline buffer of their own expose it as `buffer` and re-publish it in drain().
+    """
+    buffer = None
+    SETTINGS = ()  # Settings applied by reconfigure() (see ConfigManager)
+
+    def start(self):
+        """Starts the backend; called from the running event loop."""
+
+    async def publish_message(self, topic, message):
+        raise NotImplementedError
+
+    async def drain(self):
+        """Re-publishes buffered messages until cancelled; nothing to do without a buffer."""
+
+    async def stop(self):
+        """Finishes publishing at shutdown, once no new messages are handed over."""
+
+    def reconfigure(self, changes):
+        pass
+
+
+class MqttPublisher(Publisher):
+    def __init__(self, device_cert, device_key, root_ca, mqtt_endpoint, buffer=None):
         self.client = paho.Client(callback_api_version=paho.CallbackAPIVersion.VERSION2)
         self.device_cert = device_cert
         self.device_key = device_key
         self.root_ca = root_ca
         self.mqtt_endpoint = mqtt_endpoint
-        self.client.loop_start
+        self.buffer = buffer if buffer is not None else StoreAndForwardBuffer(BUFFER_DIR, BUFFER_SEGMENT_BYTES, BUFFER_MAX_BYTES)
+        self.connected = threading.Event()
+        self.loop = None
+        self.online = None  # asyncio.Event mirroring `connected` for the drain task
+        # mid -> (publish time, topic, message), for the ack latency metric and to buffer messages left
+        # unacknowledged by a replaced client; topic and message are None for messages drained from the buffer
+        self.pending_acks = {}
+        self.pending_lock = threading.RLock()
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         """Callback function when connected to the broker"""
-        print(f"Connected with result code {reason_code}")
+        if client is not self.client:
+            return  # Replaced by reconnect()
+        logger.info("Connected with result code %s", reason_code)
+        if not reason_code.is_failure:
+            self.connected.set()
+            self.notify_online()
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        """Callback function when the connection to the broker is lost"""
+        if client is not self.client:
+            return
+        logger.warning("Disconnected with result code %s", reason_code)
+        self.connected.clear()
 
     def on_publish(self, client, userdata, mid, reason_codes, properties):
         """Callback function when a message is successfully published"""
-        print(f"Message Published with ID {mid}")
-
-    def setup_mqtt_client(self):
-            self.client.on_connect = self.on_connect
-            self.client.on_publish = self.on_publish
-            self.client.tls_set(ca_certs=self.root_ca, certfile=self.device_cert, keyfile=self.device_key)
-            self.client.connect(self.mqtt_endpoint, 8883, 60)
+        with self.pending_lock:
+            if client is not self.client:
+                return
+            pending = self.pending_acks.pop(mid, None)
+        if pending is not None:
+            PUBLISH_ACK_LATENCY.observe(time.monotonic() - pending[0])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Message Published with ID %s", mid)
+
+    def publish(self, topic, message, buffered=False):
+        """
+        Hands a QoS 1 message to paho and tracks it until it is acknowledged. `buffered` messages
+        come from the store-and-forward buffer, which keeps them until the drain acknowledges them.
+        """
+        with self.pending_lock:
+            info = self.client.publish(topic, message, 1)
+            if info.rc in (paho.MQTT_ERR_SUCCESS, paho.MQTT_ERR_NO_CONN):
+                self.pending_acks[info.mid] = (time.monotonic(), None, None) if buffered else (time.monotonic(), topic, message)
+                MESSAGES_PUBLISHED.inc()
+        return info
+
+    def notify_online(self):
+        """Wakes up the drain task from paho's network thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.online.set)
+
+    def setup_mqtt_client(self, client=None):
+            client = self.client if client is None else client
+            client.on_connect = self.on_connect
+            client.on_disconnect = self.on_disconnect
+            client.on_publish = self.on_publish
+            client.max_queued_messages_set(MQTT_MAX_QUEUED_MESSAGES)
+            client.tls_set(ca_certs=self.root_ca, certfile=self.device_cert, keyfile=self.device_key)
+            # Connect from the network loop so that an unreachable endpoint at startup is retried
+            client.connect_async(self.mqtt_endpoint, 8883, 60)
 
     async def publish_message(self, topic, message):
-        """Asynchronous MQTT message publishing."""
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self.client.publish, topic, message, 1)
+        """
+        Asynchronous MQTT message publishing (paho's publish only queues the message, so no executor hop).
+
+        While the broker is unreachable, paho's queue is full, or older messages are still buffered,
+        the message is appended to the store-and-forward buffer instead to keep memory bounded and
+        preserve ordering.
+        """
+        if self.connected.is_set() and self.buffer.is_empty():
+            # On MQTT_ERR_NO_CONN paho still keeps the QoS 1 message queued for the next connection
+            if self.publish(topic, message).rc in (paho.MQTT_ERR_SUCCESS, paho.MQTT_ERR_NO_CONN):
+                return
+        self.buffer.append(topic, message)
+        MESSAGES_BUFFERED.inc()
+        if self.connected.is_set() and self.online is not None:
+            self.online.set()
+
+    @staticmethod
+    def is_acked(info):
+        """True if the publish behind `info` was queued and acknowledged by the broker."""
+        return info.rc in (paho.MQTT_ERR_SUCCESS, paho.MQTT_ERR_AGAIN) and info.is_published()
+
+    async def wait_for_acks(self, infos, timeout=30):
+        """Waits until the given publishes are acknowledged and returns how many leading ones were."""
+        deadline = self.loop.time() + timeout
+        while self.loop.time() < deadline and self.connected.is_set():
+            if all(self.is_acked(info) for info in infos):
+                break
+            await asyncio.sleep(0.1)
+        acked = 0
+        for info in infos:
+            if not self.is_acked(info):
+                break
+            acked += 1
+        return acked
+
+    async def drain(self, rate=None):
+        """
+        Re-publishes buffered messages whenever the broker is reachable, `rate` messages per second
+        (BUFFER_DRAIN_RATE by default). Messages are acknowledged per segment once the broker confirms
+        them. Runs until cancelled.
+        """
+        while True:
+            await self.online.wait()
+            try:
+                while self.connected.is_set() and not self.buffer.is_empty():
+                    chunk_size = rate or BUFFER_DRAIN_RATE
+                    seq, messages = self.buffer.oldest_segment()
+                    if not messages:
+                        self.buffer.ack(seq, 0, complete=True)
+                        continue
+                    logger.info("Draining %d buffered messages from segment %d", len(messages), seq)
+                    acked = 0
+                    for start in range(0, len(messages), chunk_size):
+                        chunk = messages[start:start + chunk_size]
+                        infos = [self.publish(topic, payload, buffered=True) for topic, payload in chunk]
+                        chunk_acked = await self.wait_for_acks(infos)
+                        acked += chunk_acked
+                        if chunk_acked < len(chunk):
+                            break
+                        await asyncio.sleep(1)
+                    self.buffer.ack(seq, acked, complete=acked == len(messages))
+            except Exception as e:
+                # Keep draining: while the buffer is not empty, new messages are only appended to it
+                logger.error("Error draining the store-and-forward buffer: %s", e)
+                await asyncio.sleep(1)
+            # Sleep until the next (re)connection, or until new messages are buffered while online
+            self.online.clear()
+            if self.connected.is_set() and not self.buffer.is_empty():
+                self.online.set()
 
     def start(self):
         """Start the MQTT loop."""
+        self.loop = asyncio.get_event_loop()
+        self.online = asyncio.Event()
+        if self.connected.is_set():
+            self.online.set()
+        self.client.loop_start()
+
+    async def stop(self):
+        """Seals the current buffer segment so that it is drained after a restart."""
+        self.buffer.seal()
+
+    SETTINGS = ("DEVICE_CERT", "DEVICE_KEY", "ROOT_CA", "ENDPOINT")
+
+    def reconfigure(self, changes):
+        """Reconnects with the changed endpoint or credentials (see ConfigManager)."""
+        self.reconnect_task = asyncio.create_task(self.reconnect(DEVICE_CERT, DEVICE_KEY, ROOT_CA, ENDPOINT))
+
+    async def reconnect(self, device_cert, device_key, root_ca, mqtt_endpoint, timeout=10):
+        """
+        Replaces the MQTT client to use a new endpoint or credentials. New messages go to the
+        store-and-forward buffer while the messages in flight on the old connection get up to
+        `timeout` seconds to be acknowledged. Messages still unacknowledged then are appended to the
+        buffer (messages drained from the buffer already are in it) and re-sent on the new connection.
+        If the new settings cannot be used (e.g. a missing certificate), the current connection is kept.
+        """
+        previous = (self.device_cert, self.device_key, self.root_ca, self.mqtt_endpoint)
+        self.device_cert, self.device_key, self.root_ca, self.mqtt_endpoint = device_cert, device_key, root_ca, mqtt_endpoint
+        client = paho.Client(callback_api_version=paho.CallbackAPIVersion.VERSION2)
+        try:
+            self.setup_mqtt_client(client)
+        except Exception as e:
+            self.device_cert, self.device_key, self.root_ca, self.mqtt_endpoint = previous
+            logger.error("Could not apply the new MQTT settings, keeping the current connection: %s", e)
+            return
+
+        self.connected.clear()
+        deadline = self.loop.time() + timeout
+        while self.pending_acks and self.loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        with self.pending_lock:
+            old_client = self.client
+            self.client = client
+            unacked = sorted(self.pending_acks.values(), key=lambda pending: pending[0])
+            self.pending_acks.clear()
+        unacked = [(topic, message) for _, topic, message in unacked if topic is not None]
+        for topic, message in unacked:
+            self.buffer.append(topic, message)
+            MESSAGES_BUFFERED.inc()
+        if unacked:
+            logger.warning("Buffered %d messages not acknowledged on the previous connection", len(unacked))
         self.client.loop_start()
+        old_client.disconnect()
+        old_client.loop_stop()
+        logger.info("Reconnecting to %s with the new MQTT settings", mqtt_endpoint)
+
+
+class QueuePublisher(Publisher):
+    """
+    Publisher of a worker process in sharded mode: hands encoded messages to the publishing process
+    over a multiprocessing queue instead of publishing them itself. Buffering while offline happens
+    in the publishing process, so there is no store-and-forward buffer here.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.dropped = 0
+
+    async def publish_message(self, topic, message):
+        """Queues a message for the publishing process without blocking; drops it if the queue is full."""
+        try:
+            self.messages.put_nowait((topic, message))
+        except queue.Full:
+            self.dropped += 1
+            WORKER_MESSAGES_DROPPED.inc()
+            logger.warning("Queue to the publishing process full, %d messages dropped so far", self.dropped)
+
+
+class GreengrassIpcTransport:
+    """
+    Greengrass IPC calls used by GreengrassIpcPublisher. Each call returns a concurrent.futures.Future
+    that completes once the nucleus has accepted the message. A stand-in with the same two methods
+    can replace it to run the IPC backend without a Greengrass core (see tools/benchmark.py).
+    """
+    def __init__(self):
+        if GreengrassCoreIPCClientV2 is None:
+            raise ImportError("PUBLISH_BACKEND 'ipc' needs the awsiotsdk package")
+        self.client = GreengrassCoreIPCClientV2()
+
+    def publish_to_iot_core(self, topic, payload):
+        return self.client.publish_to_iot_core_async(topic_name=topic, qos=QOS.AT_LEAST_ONCE, payload=payload)
+
+    def publish_to_topic(self, topic, payload):
+        message = PublishMessage(binary_message=BinaryMessage(message=payload))
+        return self.client.publish_to_topic_async(topic=topic, publish_message=message)
+
+
+class GreengrassIpcPublisher(Publisher):
+    """
+    Publishes through the Greengrass nucleus over IPC instead of a separate TLS connection, either
+    to AWS IoT Core ("iot_core"; the nucleus spools QoS 1 messages while offline, so there is no
+    store-and-forward buffer here) or to local publish/subscribe ("local").
+
+    At most `max_in_flight` messages wait for the nucleus' acknowledgement; beyond that
+    publish_message() waits, which backs up into the publish pipeline's overflow policy.
+    """
+    DESTINATIONS = ("iot_core", "local")
+
+    def __init__(self, transport=None, destination=None, max_in_flight=None):
+        destination = IPC_DESTINATION if destination is None else destination
+        if destination not in self.DESTINATIONS:
+            raise ValueError(f"Unknown IPC destination {destination!r}; expected one of {', '.join(self.DESTINATIONS)}")
+        self.transport = transport if transport is not None else GreengrassIpcTransport()
+        self.destination = destination
+        self.max_in_flight = max_in_flight or IPC_MAX_IN_FLIGHT
+        self.in_flight = None  # asyncio.Semaphore, created in start()
+        self.pending = 0
+        self.failed = 0
+
+    def start(self):
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+    async def publish_message(self, topic, message):
+        """Hands a message to the nucleus; its acknowledgement is handled in the background."""
+        payload = message.encode() if isinstance(message, str) else message
+        await self.in_flight.acquire()
+        try:
+            if self.destination == "iot_core":
+                future = self.transport.publish_to_iot_core(topic, payload)
+            else:
+                future = self.transport.publish_to_topic(topic, payload)
+            future = asyncio.wrap_future(future)
+        except BaseException:
+            self.in_flight.release()
+            raise
+        self.pending += 1
+        MESSAGES_PUBLISHED.inc()
+        future.add_done_callback(functools.partial(self.on_publish, topic, time.monotonic()))
+
+    def on_publish(self, topic, sent, future):
+        """Callback when the nucleus acknowledged or rejected a message."""
+        self.pending -= 1
+        self.in_flight.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            PUBLISH_ACK_LATENCY.observe(time.monotonic() - sent)
+            return
+        self.failed += 1
+        PUBLISH_FAILURES.inc()
+        logger.warning("IPC publish to %s failed (%d failures so far): %s", topic, self.failed, error)
+
+    async def stop(self, timeout=10):
+        """Waits up to `timeout` seconds for the messages in flight to be acknowledged."""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    SETTINGS = ("IPC_DESTINATION",)
+
+    def reconfigure(self, changes):
+        """Switches the destination of new messages (see ConfigManager)."""
+        self.destination = IPC_DESTINATION
+
+
+class PayloadEncoder:
+    """
+    Encodes a batch of readings from one device into an MQTT payload.
+
+    "json" produces {"device", "address", "readings": [...]}. Binary formats prefix the payload
+    with a header of magic b"BG", a version byte and a format byte:
+      - "msgpack" / "cbor": the same document as the JSON format, serialized with msgpack / cbor2.
+      - "packed": columnar layout with device and address once, followed by one column per field.
+        Integer columns use the narrowest signed type that fits, float columns are float64 (NaN for
+        missing values) and string columns are dictionary-encoded with one index byte per reading,
+        or two ("S") with more than 255 distinct values. An integer column with missing values is
+        prefixed with "?" and a bitmap of the readings that have a value (bit i of byte i // 8),
+        followed by the values of those readings only.
+    """
+    MAGIC = b"BG"
+    VERSION = 1
+    FORMAT_IDS = {"msgpack": 1, "cbor": 2, "packed": 3}
+    HEADER = struct.Struct("<2sBB")
+
+    def __init__(self, payload_format=PAYLOAD_FORMAT):
+        if payload_format not in ("json", "msgpack", "cbor", "packed"):
+            raise ValueError(f"Unknown payload format: {payload_format}")
+        if payload_format == "msgpack" and msgpack is None:
+            raise ImportError("Payload format 'msgpack' requires the msgpack package")
+        if payload_format == "cbor" and cbor2 is None:
+            raise ImportError("Payload format 'cbor' requires the cbor2 package")
+        self.payload_format = payload_format
+        self.header = self.HEADER.pack(self.MAGIC, self.VERSION, self.FORMAT_IDS[payload_format]) if payload_format != "json" else b""
+
+    @staticmethod
+    def document(batch):
+        first = batch[0]
+        readings = [{key: value for key, value in message.items() if key not in ("device", "address")} for message in batch]
+        return {"device": first["device"], "address": first["address"], "readings": readings}
+
+    def encode(self, batch):
+        """Returns the payload (str for JSON, bytes otherwise) for a non-empty batch."""
+        if self.payload_format == "json":
+            return json.dumps(self.document(batch))
+        if self.payload_format == "msgpack":
+            return self.header + msgpack.packb(self.document(batch))
+        if self.payload_format == "cbor":
+            return self.header + cbor2.dumps(self.document(batch))
+        return self.header + self.pack_columns(batch)
+
+    @staticmethod
+    def pack_string(text):
+        encoded = text.encode()[:255]
+        return bytes((len(encoded),)) + encoded
+
+    @classmethod
+    def pack_columns(cls, batch):
+        count = len(batch)
+        fields = []
+        for message in batch:
+            for key in message:
+                if key not in ("device", "address") and key not in fields:
+                    fields.append(key)
+
+        parts = [cls.pack_string(str(batch[0]["device"])), cls.pack_string(str(batch[0]["address"])),
+                 struct.pack("<HB", count, len(fields))]
+        for field in fields:
+            column = [message.get(field) for message in batch]
+            parts.append(cls.pack_string(field))
+            present = [value for value in column if value is not None]
+            if present and all(isinstance(value, int) for value in present):
+                low, high = min(present), max(present)
+                code = next(code for code, bits in (("b", 8), ("h", 16), ("i", 32), ("q", 64))
+                            if -(1 << (bits - 1)) <= low and high < (1 << (bits - 1)))
+                if len(present) < count:
+                    bitmap = bytearray((count + 7) // 8)
+                    for position, value in enumerate(column):
+                        if value is not None:
+                            bitmap[position // 8] |= 1 << (position % 8)
+                    parts.append(b"?" + bytes(bitmap))
+                parts.append(code.encode() + struct.pack(f"<{len(present)}{code}", *present))
+            elif all(isinstance(value, (int, float)) or value is None for value in column):
+                parts.append(b"d" + struct.pack(f"<{count}d", *(float("nan") if value is None else value for value in column)))
+            else:
+                labels = list(dict.fromkeys("" if value is None else str(value) for value in column))
+                index = {label: position for position, label in enumerate(labels)}
+                indices = [index["" if value is None else str(value)] for value in column]
+                if len(labels) <= 255:
+                    parts.append(b"s" + bytes((len(labels),)) + b"".join(cls.pack_string(label) for label in labels) + bytes(indices))
+                else:
+                    parts.append(b"S" + struct.pack("<H", len(labels)) + b"".join(cls.pack_string(label) for label in labels)
+                                 + struct.pack(f"<{count}H", *indices))
+        return b"".join(parts)
+
+
+class PublishPipeline:
+    """
+    Batches readings per topic in front of the MQTT publisher.
+
+    Readings are submitted without blocking into a bounded queue and published from a single
+    task: a topic's batch is encoded into one message (see PayloadEncoder) once it holds `batch_size` readings or its
+    oldest reading is `flush_interval` seconds old. When the queue is full, the oldest queued
+    reading ("drop_oldest") or the incoming one ("drop_newest") is dropped and counted.
+    """
+    def __init__(self, publisher, batch_size=PUBLISH_BATCH_SIZE, flush_interval=PUBLISH_FLUSH_INTERVAL,
+                 queue_size=PUBLISH_QUEUE_SIZE, overflow_policy=PUBLISH_OVERFLOW_POLICY, encoder=None):
+        if overflow_policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.publisher = publisher
+        self.encoder = encoder or PayloadEncoder()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batches = {}  # topic -> list of readings
+        self.batch_started = {}  # topic -> loop time of the oldest reading in the batch
+        self.dropped = 0
+        self.published = 0
+
+    SETTINGS = ("PUBLISH_BATCH_SIZE", "PUBLISH_FLUSH_INTERVAL", "PUBLISH_OVERFLOW_POLICY", "PAYLOAD_FORMAT")
+
+    def reconfigure(self, changes):
+        """Applies changed batching settings (see ConfigManager); pending batches keep their readings."""
+        self.batch_size = changes.get("PUBLISH_BATCH_SIZE", self.batch_size)
+        self.flush_interval = changes.get("PUBLISH_FLUSH_INTERVAL", self.flush_interval)
+        self.overflow_policy = changes.get("PUBLISH_OVERFLOW_POLICY", self.overflow_policy)
+        if "PAYLOAD_FORMAT" in changes:
+            self.encoder = PayloadEncoder(changes["PAYLOAD_FORMAT"])
+
+    def submit(self, topic, message):
+        """Queues a reading for publishing without blocking, applying the overflow policy when full."""
+        try:
+            self.queue.put_nowait((topic, message))
+            return
+        except asyncio.QueueFull:
+            pass
+
+        self.dropped += 1
+        READINGS_DROPPED.inc()
+        logger.warning("Publish queue full, %d readings dropped so far (%s)", self.dropped, self.overflow_policy)
+        if self.overflow_policy == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait((topic, message))
+
+    def add(self, topic, message):
+        """Adds a reading to its topic's batch and returns True if the batch is full."""
+        batch = self.batches.get(topic)
+        if batch is None:
+            batch = self.batches[topic] = []
+            self.batch_started[topic] = asyncio.get_event_loop().time()
+        batch.append(message)
+        return len(batch) >= self.batch_size
+
+    async def flush(self, topic):
+        """Publishes the pending batch of a topic."""
+        batch = self.batches.pop(topic, None)
+        self.batch_started.pop(topic, None)
+        if not batch:
+            return
+        try:
+            await self.publisher.publish_message(topic, self.encoder.encode(batch))
+            self.published += len(batch)
+        except Exception as e:
+            logger.error("Error publishing batch of %d readings to %s: %s", len(batch), topic, e)
+
+    async def flush_expired(self):
+        """Publishes all batches whose oldest reading has waited `flush_interval` seconds."""
+        deadline = asyncio.get_event_loop().time() - self.flush_interval
+        for topic in [topic for topic, started in self.batch_started.items() if started <= deadline]:
+            await self.flush(topic)
+
+    async def flush_all(self):
+        """Moves everything still queued into batches and publishes all of them."""
+        while not self.queue.empty():
+            self.add(*self.queue.get_nowait())
+        for topic in list(self.batches):
+            await self.flush(topic)
+
+    async def run(self):
+        """Publishing loop; flushes what is pending when cancelled."""
+        try:
+            while True:
+                timeout = None
+                if self.batch_started:
+                    oldest = min(self.batch_started.values())
+                    timeout = max(0, oldest + self.flush_interval - asyncio.get_event_loop().time())
+                # asyncio.wait() rather than wait_for(): on Python 3.11 wait_for() can swallow
+                # a cancellation that races with the queue, which would hang shutdown.
+                getter = asyncio.ensure_future(self.queue.get())
+                try:
+                    await asyncio.wait((getter,), timeout=timeout)
+                finally:
+                    getter.cancel()
+                    reading = getter.result() if getter.done() and not getter.cancelled() else None
+                    full = reading is not None and self.add(*reading)
+                if full:
+                    await self.flush(reading[0])
+                await self.flush_expired()
+        except asyncio.CancelledError:
+            await self.flush_all()
+            raise
+
+
+def shard_of(device_address, shards):
+    """Returns the worker (0 to shards - 1) that handles a device in sharded mode."""
+    return zlib.crc32(device_address.upper().encode()) % shards
+
+
+class DeviceEntry:
+    """A device seen advertising the gateway's manufacturer ID."""
+    def __init__(self, name, address, rssi, ble_device=None, adapter=None):
+        self.name = name
+        self.address = address
+        self.rssi = rssi
+        self.ble_device = ble_device
+        self.adapter = adapter  # Adapter the device was last seen on
+        self.last_seen = time.monotonic()
+
+
+class DeviceRegistry:
+    """
+    Incremental registry of devices advertising a manufacturer ID, keyed by address.
+
+    Advertisements update the entry's RSSI and last-seen time as they arrive. Listeners are
+    called with ("add", entry) when a device first appears and ("expire", entry) when it has
+    not been seen for `expiry` seconds. With a `shard` of (index, count), only devices that
+    shard_of() assigns to `index` are registered.
+    """
+    def __init__(self, manufacturer_id, expiry=DEVICE_EXPIRY, shard=None):
+        self.manufacturer_id = manufacturer_id
+        self.expiry = expiry
+        self.shard = shard
+        self.entries = {}  # device_address -> DeviceEntry
+        self.listeners = []
+
+    @property
+    def devices(self):
+        """List of (device_name, device_address) tuples for all registered devices."""
+        return [(entry.name, entry.address) for entry in self.entries.values()]
+
+    def add_listener(self, callback):
+        """Registers a callback(event, entry) for "add" and "expire" events."""
+        self.listeners.append(callback)
+
+    def notify(self, event, entry):
+        for callback in self.listeners:
+            try:
+                callback(event, entry)
+            except Exception as e:
+                logger.error("Error in registry listener for %s %s: %s", event, entry.address, e)
+
+    def update(self, device, adv_data, adapter=None):
+        """
+        Applies an advertisement received on `adapter` to the registry.
+
+        Returns:
+            bool: True if the advertisement carries the registry's manufacturer ID and the device belongs to its shard.
+        """
+        manufacturer_data = adv_data.manufacturer_data
+        if not manufacturer_data or next(iter(manufacturer_data)) != self.manufacturer_id:
+            return False
+
+        entry = self.entries.get(device.address)
+        if entry is None:
+            if self.shard is not None and shard_of(device.address, self.shard[1]) != self.shard[0]:
+                return False
+            entry = DeviceEntry(device.name or adv_data.local_name or "Unknown", device.address, adv_data.rssi, device, adapter)
+            self.entries[device.address] = entry
+            self.notify("add", entry)
+        else:
+            entry.rssi = adv_data.rssi
+            entry.ble_device = device
+            entry.adapter = adapter
+            entry.last_seen = time.monotonic()
+            if entry.name == "Unknown" and (device.name or adv_data.local_name):
+                entry.name = device.name or adv_data.local_name
+        return True
+
+    def restore(self, name, address, rssi, ble_device=None, adapter=None):
+        """
+        Registers a device known from a snapshot before it is seen advertising.
+
+        Returns:
+            bool: True if the device was added, False if it is already registered or outside the shard.
+        """
+        if address in self.entries or (self.shard is not None and shard_of(address, self.shard[1]) != self.shard[0]):
+            return False
+        entry = self.entries[address] = DeviceEntry(name, address, rssi, ble_device, adapter)
+        self.notify("add", entry)
+        return True
+
+    def touch(self, device_address):
+        """Marks a device as alive, e.g. when a notification is received from it."""
+        entry = self.entries.get(device_address)
+        if entry is not None:
+            entry.last_seen = time.monotonic()
+
+    def connect_target(self, device_address, adapter=None):
+        """
+        Returns the BLEDevice for an address if it was seen on `adapter` (avoids a scan on connect),
+        else the address. A BLEDevice found by one adapter cannot be connected through another.
+        """
+        entry = self.entries.get(device_address)
+        if entry is None or entry.ble_device is None or (adapter is not None and entry.adapter not in (None, adapter)):
+            return device_address
+        return entry.ble_device
+
+    def expire(self, keep=()):
+        """Removes devices not seen for `expiry` seconds, except the addresses in `keep`."""
+        deadline = time.monotonic() - self.expiry
+        for device_address in [address for address, entry in self.entries.items() if entry.last_seen < deadline and address not in keep]:
+            self.notify("expire", self.entries.pop(device_address))
+
+
+def list_adapters():
+    """Returns the names of the local HCI adapters (hci0, hci1, ...), or ["hci0"] if none can be listed."""
+    try:
+        adapters = [name for name in os.listdir("/sys/class/bluetooth") if name.startswith("hci") and name[3:].isdigit()]
+    except OSError:
+        adapters = []
+    return sorted(adapters, key=lambda name: int(name[3:])) or ["hci0"]
+
+
+class AdapterScheduler:
+    """
+    Spreads BLE connections over the local adapters.
+
+    Each adapter accepts up to `max_connections` connections. A connection goes to the free adapter
+    with the lowest score, which grows with the adapter's load, a weaker RSSI for the device on that
+    adapter and recent connection failures from that adapter to the device. The scan adapter is
+    only used for connections once the other adapters are busier.
+
+    The RSSI on the scan adapter comes from advertisements, and on the other adapters from the
+    device objects BlueZ keeps under them (see SensorGateway.refresh_bluez_devices()). Adapters
+    without a recent RSSI for the device get a neutral score.
+
+    When all slots are taken, devices wait in line and get slots in the order they started waiting.
+    Persistent connections make way for devices that waited too long (see rotate()).
+    """
+    def __init__(self, adapters, max_connections):
+        self.adapters = list(adapters)
+        self.scan_adapter = self.adapters[0]
+        self.max_connections = max_connections
+        self.load = {adapter: 0 for adapter in self.adapters}
+        self.rssi = {}  # (adapter, device_address) -> last RSSI
+        self.failures = {}  # (adapter, device_address) -> consecutive connection failures
+        self.released = asyncio.Event()
+        self.waiters = collections.deque()  # (future, device_address, loop time it started waiting)
+        self.rotating = set()  # Addresses of connections closing to make way for waiting devices
+
+    def set_max_connections(self, max_connections):
+        """Changes the per-adapter limit; connections above a lowered limit are kept until they end."""
+        self.max_connections = max_connections
+        self.hand_over()
+        self.released.set()
+
+    def record_rssi(self, adapter, device_address, rssi):
+        self.rssi[(adapter, device_address)] = rssi
+
+    def set_adapter_rssi(self, adapter, rssi):
+        """Replaces the RSSI of all devices on `adapter` with the {device_address: rssi} given."""
+        for key in [key for key in self.rssi if key[0] == adapter]:
+            del self.rssi[key]
+        self.rssi.update(((adapter, device_address), value) for device_address, value in rssi.items())
+
+    def record_result(self, adapter, device_address, success):
+        """Records the outcome of a connection attempt from `adapter` to the device."""
+        if success:
+            self.failures.pop((adapter, device_address), None)
+        else:
+            self.failures[(adapter, device_address)] = self.failures.get((adapter, device_address), 0) + 1
+
+    def score(self, adapter, device_address):
+        score = self.load[adapter] / self.max_connections
+        rssi = self.rssi.get((adapter, device_address))
+        score += 0.2 if rssi is None else min(max(-50 - rssi, 0), 50) / 100  # 0 at -50 dBm, 0.5 at -100 dBm
+        score += 0.5 * min(self.failures.get((adapter, device_address), 0), 4)
+        if adapter == self.scan_adapter and len(self.adapters) > 1:
+            score += 0.5
+        return score
+
+    def choose(self, device_address):
+        """Returns the best adapter with a free connection slot, or None if all are full."""
+        free = [adapter for adapter in self.adapters if self.load[adapter] < self.max_connections]
+        return min(free, key=lambda adapter: (self.score(adapter, device_address), adapter == self.scan_adapter)) if free else None
+
+    def hand_over(self):
+        """Gives free slots to the devices waiting the longest."""
+        while self.waiters:
+            waiter, device_address, _ = self.waiters[0]
+            adapter = self.choose(device_address)
+            if adapter is None:
+                break
+            self.waiters.popleft()
+            if not waiter.done():  # Skip waiters that were cancelled
+                self.load[adapter] += 1
+                waiter.set_result(adapter)
+
+    def release(self, adapter, device_address):
+        self.load[adapter] -= 1
+        self.rotating.discard(device_address)
+        self.hand_over()
+        self.released.set()
+
+    def rotate(self, device_address, connected_since):
+        """
+        Returns True if the connection to the device, made at loop time `connected_since`, should be
+        closed to make way for a device that has waited for a slot at least STREAM_ROTATE_INTERVAL
+        seconds. Each waiting device makes one connection close.
+        """
+        now = asyncio.get_event_loop().time()
+        if not STREAM_ROTATE_INTERVAL or now - connected_since < STREAM_ROTATE_INTERVAL or device_address in self.rotating:
+            return False
+        starved = sum(1 for _, _, since in self.waiters if now - since >= STREAM_ROTATE_INTERVAL)
+        if starved <= len(self.rotating):
+            return False
+        self.rotating.add(device_address)
+        return True
+
+    @contextlib.asynccontextmanager
+    async def slot(self, device_address):
+        """Waits for a free connection slot and yields the adapter to connect through."""
+        adapter = None if self.waiters else self.choose(device_address)
+        if adapter is None:
+            waiter = asyncio.get_event_loop().create_future()
+            entry = (waiter, device_address, asyncio.get_event_loop().time())
+            self.waiters.append(entry)
+            try:
+                adapter = await waiter
+            except asyncio.CancelledError:
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+                elif waiter.done() and not waiter.cancelled():
+                    self.release(waiter.result(), device_address)  # Handed over just before the cancellation
+                raise
+        else:
+            self.load[adapter] += 1
+        try:
+            yield adapter
+        finally:
+            self.release(adapter, device_address)
+
+
+class SessionEngine:
+    """
+    Runs BLE sessions for many devices concurrently, bounded by the adapters' connection limits,
+    and keeps per-device sample statistics.
+    """
+    def __init__(self, gateway, max_connections, adapters=("hci0",)):
+        self.gateway = gateway
+        self.max_connections = max_connections
+        self.scheduler = AdapterScheduler(adapters, max_connections)
+        self.sample_counts = {}  # device_address -> number of samples received
+        self.first_sample_time = {}  # device_address -> loop time of the first session start
+        self.active_sessions = set()
+        self.stream_tasks = {}  # device_address -> task keeping a persistent connection
+        self.connected = set()  # addresses with an established connection
+
+    def record_sample(self, device_address):
+        """Counts a received sample for the given device."""
+        self.sample_counts[device_address] = self.sample_counts.get(device_address, 0) + 1
+
+    def sample_rates(self):
+        """Returns the average samples per second observed for each device since its first session."""
+        now = asyncio.get_event_loop().time()
+        rates = {}
+        for device_address, start_time in self.first_sample_time.items():
+            elapsed = now - start_time
+            rates[device_address] = self.sample_counts.get(device_address, 0) / elapsed if elapsed > 0 else 0.0
+        return rates
+
+    async def run_session(self, device_name, device_address, listen_time=None):
+        """
+        Waits for a free connection slot, then runs one session with the device.
+
+        Returns:
+            bool: True if the device was connected and listened to.
+        """
+        async with self.scheduler.slot(device_address) as adapter:
+            self.first_sample_time.setdefault(device_address, asyncio.get_event_loop().time())
+            self.active_sessions.add(device_address)
+            try:
+                logger.info("Connecting to %s (%s) via %s...", device_name, device_address, adapter)
+                return await self.gateway.read_data_from_device(device_name, device_address, adapter, listen_time)
+            except Exception as e:
+                logger.warning("Failed to collect data from %s (%s): %s", device_name, device_address, e)
+                return False
+            finally:
+                self.active_sessions.discard(device_address)
+                logger.info("Finished processing %s (%s).", device_name, device_address)
+
+    async def run_all(self, devices):
+        """Runs one session for each device, at most `max_connections` per adapter at a time."""
+        await asyncio.gather(*(self.run_session(device_name, device_address) for device_name, device_address in devices))
+
+    async def stream_session(self, device_name, device_address):
+        """Runs the persistent session with the device; connection slots are taken per connection."""
+        self.first_sample_time.setdefault(device_address, asyncio.get_event_loop().time())
+        self.active_sessions.add(device_address)
+        try:
+            await self.gateway.stream_from_device(device_name, device_address)
+        finally:
+            self.active_sessions.discard(device_address)
+
+    def start_streaming(self, devices):
+        """Starts a persistent session for every device that does not already have one."""
+        for device_name, device_address in devices:
+            task = self.stream_tasks.get(device_address)
+            if task is None or task.done():
+                self.stream_tasks[device_address] = asyncio.create_task(self.stream_session(device_name, device_address))
+
+    def on_registry_event(self, event, entry):
+        """Starts streaming from newly registered devices and stops reconnecting to expired ones."""
+        if event == "add":
+            self.start_streaming([(entry.name, entry.address)])
+        elif event == "expire":
+            task = self.stream_tasks.pop(entry.address, None)
+            if task is not None:
+                task.cancel()
+
+    def restart_streaming(self):
+        """Reconnects all persistent sessions, e.g. to subscribe to changed characteristics."""
+        if self.stream_tasks:
+            self.restart_task = asyncio.create_task(self.restart_all())
+
+    async def restart_all(self):
+        await self.stop_streaming()
+        self.start_streaming(self.gateway.devices)
+
+    async def stop_streaming(self):
+        """Cancels all persistent sessions and waits for their connections to close."""
+        tasks = list(self.stream_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.stream_tasks.clear()
+
+    def log_sample_rates(self):
+        """Logs the per-device sample rate."""
+        for device_address, rate in self.sample_rates().items():
+            logger.info("Sample rate for %s: %.2f samples/s (%d total)", device_address, rate, self.sample_counts.get(device_address, 0))
+
+
+class PollState:
+    """Polling schedule and statistics of one device."""
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.due = None  # Loop time of the next poll
+        self.listen = LISTEN_WINDOW
+        self.failures = 0  # Consecutive failed connections
+        self.notification_rate = None  # Moving averages per listened second
+        self.change_rate = None
+        self.samples = 0  # Notifications and reading changes during the current poll
+        self.changes = 0
+        self.last_values = {}  # char_uuid -> values of the last reading, without its timestamp
+
+
+class PollScheduler:
+    """
+    Adaptive polling schedule, used instead of persistent connections when PERSISTENT_CONNECTIONS is False.
+
+    Devices wait in a priority queue ordered by the time of their next poll; due devices are polled,
+    most overdue first, whenever a connection slot is free. After each poll, the device's notification
+    rate and change rate (readings that differ from the previous one of the same characteristic) are
+    folded into moving averages, and:
+      - the listen window is set to capture about POLL_SAMPLES notifications,
+      - the interval to the next poll is the time in which about POLL_CHANGES changes accumulate,
+      - both are stretched for weak links (fewer, longer connections), then clamped to their bounds,
+      - the interval never exceeds the latency budget of a characteristic the device exposes,
+      - failed connections back off exponentially from POLL_INTERVAL_MIN up to POLL_INTERVAL_MAX.
+    """
+    SMOOTHING = 0.5  # Weight of the latest poll in the moving averages
+
+    def __init__(self, gateway, latency_budgets=None):
+        self.gateway = gateway
+        self.set_latency_budgets(LATENCY_BUDGETS if latency_budgets is None else latency_budgets)
+        self.states = {}  # device_address -> PollState
+        self.queue = []  # heap of (due, sequence, device_address)
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+        self.active = False
+
+    def set_latency_budgets(self, latency_budgets):
+        """Sets the latency budgets, keyed by characteristic name, of the gateway's characteristics."""
+        characteristic_uuids = self.gateway.characteristic_uuids
+        self.budgets = {characteristic_uuids[name]: budget for name, budget in latency_budgets.items() if name in characteristic_uuids}
+
+    def schedule(self, state, delay):
+        state.due = asyncio.get_event_loop().time() + delay
+        heapq.heappush(self.queue, (state.due, next(self.sequence), state.address))
+        self.wakeup.set()
+
+    def on_registry_event(self, event, entry):
+        """Polls newly registered devices right away and forgets expired ones."""
+        if event == "add" and entry.address not in self.states:
+            self.states[entry.address] = state = PollState(entry.name, entry.address)
+            self.schedule(state, 0)
+        elif event == "expire":
+            self.states.pop(entry.address, None)  # Its queue entry is skipped when popped
+
+    def record(self, device_address, char_uuid, reading):
+        """Counts a decoded reading, and whether it changed, for the device's current poll."""
+        state = self.states.get(device_address)
+        if state is None:
+            return
+        state.samples += 1
+        values = tuple(value for field, value in reading.items() if field != "timestamp")
+        previous = state.last_values.get(char_uuid)
+        if previous is not None and previous != values:
+            state.changes += 1
+        state.last_values[char_uuid] = values
+
+    def latency_budget(self, device_address):
+        """Smallest latency budget of the device's characteristics (all configured ones until discovered)."""
+        characteristics = self.gateway.gatt_cache.get(device_address, self.budgets)
+        budgets = [budget for char_uuid, budget in self.budgets.items() if char_uuid in characteristics]
+        return min(budgets) if budgets else None
+
+    def update(self, state, connected):
+        """Folds the outcome of a poll into the device's statistics and returns the delay until its next poll."""
+        if not connected:
+            state.failures += 1
+            return min(POLL_INTERVAL_MIN * 2 ** min(state.failures - 1, 16), POLL_INTERVAL_MAX) * random.uniform(0.75, 1.0)
+
+        state.failures = 0
+        notification_rate = state.samples / state.listen
+        change_rate = state.changes / state.listen
+        if state.notification_rate is None:
+            state.notification_rate, state.change_rate = notification_rate, change_rate
+        else:
+            state.notification_rate += self.SMOOTHING * (notification_rate - state.notification_rate)
+            state.change_rate += self.SMOOTHING * (change_rate - state.change_rate)
+
+        listen = POLL_SAMPLES / state.notification_rate if state.notification_rate else POLL_LISTEN_MIN
+        interval = POLL_CHANGES / state.change_rate if state.change_rate else POLL_INTERVAL_MAX
+        entry = self.gateway.registry.entries.get(state.address)
+        if entry is not None and entry.rssi is not None:
+            stretch = 1 + min(max(-70 - entry.rssi, 0), 20) / 20  # 1 at -70 dBm, 2 at -90 dBm and below
+            listen *= stretch
+            interval *= stretch
+        state.listen = min(max(listen, POLL_LISTEN_MIN), POLL_LISTEN_MAX)
+        interval = min(max(interval, POLL_INTERVAL_MIN), POLL_INTERVAL_MAX)
+        budget = self.latency_budget(state.address)
+        return interval if budget is None else min(interval, budget)
+
+    async def poll(self, state):
+        """Runs one session with a device and schedules its next poll, even if the session or the update fails."""
+        delay = POLL_INTERVAL_MAX
+        try:
+            state.samples = state.changes = 0
+            connected = await self.gateway.session_engine.run_session(state.name, state.address, state.listen)
+            delay = self.update(state, connected)
+        except Exception as e:
+            logger.error("Error polling %s (%s): %s", state.name, state.address, e)
+        finally:
+            if self.states.get(state.address) is state:
+                logger.info("Next poll of %s (%s) in %.0fs, listening %.0fs", state.name, state.address, delay, state.listen)
+                self.schedule(state, delay)
+
+    async def run(self):
+        """Starts the polls of due devices while connection slots are free. Runs until cancelled."""
+        loop = asyncio.get_event_loop()
+        scheduler = self.gateway.session_engine.scheduler
+        self.active = True
+        try:
+            while True:
+                if self.queue and self.queue[0][0] <= loop.time():
+                    if scheduler.choose(self.queue[0][2]) is None:
+                        scheduler.released.clear()
+                        await scheduler.released.wait()
+                        continue
+                    due, _, device_address = heapq.heappop(self.queue)
+                    state = self.states.get(device_address)
+                    if state is None or state.due != due:
+                        continue  # Expired or rescheduled
+                    task = asyncio.create_task(self.poll(state))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    await asyncio.sleep(0)  # Let the poll take its slot before looking at the next device
+                    continue
+
+                self.wakeup.clear()
+                waiter = asyncio.ensure_future(self.wakeup.wait())
+                try:
+                    await asyncio.wait((waiter,), timeout=self.queue[0][0] - loop.time() if self.queue else None)
+                finally:
+                    waiter.cancel()
+        finally:
+            self.active = False
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
 
 class SensorGateway:
     """
     A gateway to handle Bluetooth communication, collect temperature data, and publish to MQTT.
     """
-    def __init__(self, manufacturer_id, service_uuid, characteristic_uuids, mqtt_publisher):
+    def __init__(self, manufacturer_id, service_uuid, characteristic_uuids, mqtt_publisher, max_connections=MAX_CONNECTIONS, publish_pipeline=None, adapters=None, shard=None):
         self.manufacturer_id = manufacturer_id
+        self.registry = DeviceRegistry(manufacturer_id, DEVICE_EXPIRY, shard=shard)
+        self.gatt_cache = {}  # device_address -> characteristic UUIDs found on the device
+        self.topics = {}  # (device_name, device_address, stream) -> MQTT topic
+        self.mqtt_publisher = mqtt_publisher
+        self.publish_pipeline = publish_pipeline or PublishPipeline(
+            mqtt_publisher, PUBLISH_BATCH_SIZE, PUBLISH_FLUSH_INTERVAL, PUBLISH_QUEUE_SIZE, PUBLISH_OVERFLOW_POLICY, PayloadEncoder(PAYLOAD_FORMAT))
+        self.stream_processor = StreamProcessor(STREAM_PROCESSING, self.publish_pipeline.submit)
+        self.set_characteristics(service_uuid, characteristic_uuids)
+        self.adapters = list(adapters or ADAPTERS or list_adapters())
+        self.scan_adapter = self.adapters[0]
+        self.session_engine = SessionEngine(self, max_connections, self.adapters)
+        self.poll_scheduler = PollScheduler(self)
+        self.clocks = ClockAligner()
+        self.registry.add_listener(self.clocks.on_registry_event)
+        self.alert_engine = AlertEngine(ALERT_RULES, mqtt_publisher)
+        self.registry.add_listener(self.alert_engine.on_registry_event)
+        self.history = None
+        if HISTORY_SIZE:
+            # Workers of sharded mode keep their own files, as they serve different devices
+            history_dir = os.path.join(HISTORY_DIR, f"worker{shard[0]}") if shard else HISTORY_DIR
+            self.history = ReadingHistory(HISTORY_SIZE, history_dir if HISTORY_PERSIST else None, HISTORY_MAX_SERIES)
+        self.scanner = None
+        self.bluez_devices = {}  # (adapter, device_address) -> BLEDevice of a device object BlueZ already has
+
+    @property
+    def devices(self):
+        """List of (device_name, device_address) tuples for the devices currently in the registry."""
+        return self.registry.devices
+
+    def set_characteristics(self, service_uuid, characteristic_uuids):
+        """Sets the service and characteristics to subscribe to, with their decoders and stream rules."""
         self.service_uuid = service_uuid
         self.characteristic_uuids = characteristic_uuids
-        self.devices = []
-        self.mqtt_publisher = mqtt_publisher
-        self.setup_bluetooth()
+        self.characteristic_names = {char_uuid: name for name, char_uuid in characteristic_uuids.items()}
+        self.decoders = {char_uuid: CHARACTERISTIC_DECODERS[name] for name, char_uuid in characteristic_uuids.items() if name in CHARACTERISTIC_DECODERS}
+        self.stream_rules = {char_uuid: self.stream_processor.rules[name] for name, char_uuid in characteristic_uuids.items() if name in self.stream_processor.rules}
 
-    def setup_bluetooth(self):
-        """
-        Initializes the SensorGateway.
+    SETTINGS = ("STMICROELECTRONICS_MANUFACTURER_KEY", "DEVICE_EXPIRY", "MAX_CONNECTIONS", "SERVICE_UUID",
+                "CHARACTERISTIC_UUIDS", "STREAM_PROCESSING", "LATENCY_BUDGETS", "TIMESTAMP_TICK", "TIMESTAMP_MAX_DRIFT",
+                "TIMESTAMP_WINDOW", "TIMESTAMP_RESET_ERROR")
 
-        Args:
-            manufacturer_id (int): The BLE manufacturer ID to filter devices.
-            service_uuid (str): The UUID of the service to search for.
-            characteristic_uuids (list): List of characteristic UUIDs to subscribe to.
+    def reconfigure(self, changes):
+        """
+        Applies changed settings (see ConfigManager) to the running gateway. Connections are only
+        restarted when the service or the characteristics to subscribe to changed.
+        """
+        if "STMICROELECTRONICS_MANUFACTURER_KEY" in changes:
+            self.manufacturer_id = self.registry.manufacturer_id = changes["STMICROELECTRONICS_MANUFACTURER_KEY"]
+        if "DEVICE_EXPIRY" in changes:
+            self.registry.expiry = changes["DEVICE_EXPIRY"]
+        if "MAX_CONNECTIONS" in changes:
+            shards = self.registry.shard[1] if self.registry.shard else 1
+            self.session_engine.scheduler.set_max_connections(max(1, changes["MAX_CONNECTIONS"] // shards))
+        if "STREAM_PROCESSING" in changes:
+            self.stream_processor.configure(changes["STREAM_PROCESSING"])
+        characteristics_changed = "SERVICE_UUID" in changes or "CHARACTERISTIC_UUIDS" in changes
+        if characteristics_changed or "STREAM_PROCESSING" in changes:
+            self.set_characteristics(SERVICE_UUID, CHARACTERISTIC_UUIDS)
+        if characteristics_changed or "LATENCY_BUDGETS" in changes:
+            self.poll_scheduler.set_latency_budgets(LATENCY_BUDGETS)
+        if any(name.startswith("TIMESTAMP_") for name in changes):
+            self.clocks.clocks.clear()  # Fitted again with the new settings
+        if characteristics_changed:
+            self.gatt_cache.clear()
+            self.session_engine.restart_streaming()
+
+    async def setup_bluetooth(self):
         """
+        Checks the adapters through BlueZ over D-Bus and powers on the ones that are off. The device
+        objects BlueZ already has are kept in `bluez_devices`, so that devices restored from a snapshot
+        can be connected without a scan. Without dbus_fast, the adapters are brought up with hciconfig.
+        """
+        if MessageBus is None:
+            try:
+                for adapter in self.adapters:
+                    subprocess.run(["hciconfig", adapter, "up"], check=True)
+                    logger.info("Bluetooth interface %s brought up successfully.", adapter)
+            except subprocess.CalledProcessError as e:
+                logger.error("Error setting up Bluetooth: %s", e)
+                exit(1)
+            return
+
         try:
-            subprocess.run(["hciconfig", "hci0", "up"], check=True)
-            print("Bluetooth interface hci0 brought up successfully.")
-            result = subprocess.run(["hciconfig", "-a"], check=True, text=True, capture_output=True)
-            print("Bluetooth interface configuration:")
-            print(result.stdout)
-        except subprocess.CalledProcessError as e:
-            print(f"Error setting up Bluetooth: {e}")
+            bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+            try:
+                objects = await bluez_objects(bus)
+                for adapter in self.adapters:
+                    properties = objects.get(f"/org/bluez/{adapter}", {}).get("org.bluez.Adapter1")
+                    if properties is None:
+                        raise ConnectionError(f"adapter {adapter} not found")
+                    if not properties.get("Powered"):
+                        reply = await bus.call(Message(destination="org.bluez", path=f"/org/bluez/{adapter}",
+                                                       interface="org.freedesktop.DBus.Properties", member="Set", signature="ssv",
+                                                       body=["org.bluez.Adapter1", "Powered", Variant("b", True)]))
+                        if reply.message_type == MessageType.ERROR:
+                            raise ConnectionError(f"could not power on {adapter}: {reply.error_name} {reply.body}")
+                    logger.info("Bluetooth interface %s (%s) is up.", adapter, properties.get("Address"))
+            finally:
+                bus.disconnect()
+        except Exception as e:
+            logger.error("Error setting up Bluetooth: %s", e)
             exit(1)
+        try:
+            self.update_bluez_devices(objects)
+        except Exception as e:
+            # Only an optimization: restored devices are then connected by address
+            logger.warning("Could not use the BlueZ device objects: %s", e)
+
+    def update_bluez_devices(self, objects):
+        """
+        Replaces `bluez_devices` with the device objects BlueZ has under each adapter, and the RSSI
+        of registered devices on the adapters other than the scan adapter with the one BlueZ reports.
+        """
+        devices = {}
+        rssi = {adapter: {} for adapter in self.adapters if adapter != self.scan_adapter}
+        for path, interfaces in objects.items():
+            properties = interfaces.get("org.bluez.Device1")
+            adapter = path.split("/")[3] if path.count("/") == 4 else None
+            if properties is None or adapter not in self.adapters or "Address" not in properties:
+                continue
+            device_address = properties["Address"]
+            devices[(adapter, device_address)] = BLEDevice(device_address, properties.get("Name"), {"path": path, "props": properties})
+            if adapter in rssi and "RSSI" in properties and device_address in self.registry.entries:
+                rssi[adapter][device_address] = properties["RSSI"]
+        self.bluez_devices = devices
+        for adapter, adapter_rssi in rssi.items():
+            self.session_engine.scheduler.set_adapter_rssi(adapter, adapter_rssi)
+
+    async def refresh_bluez_devices(self):
+        """
+        Reads BlueZ's device objects every BLUEZ_REFRESH_INTERVAL seconds (see update_bluez_devices()),
+        so that connections through any adapter can use a device object BlueZ already has and the
+        device's RSSI on that adapter. The interval is read on every iteration, so it can be changed
+        at runtime; while it is 0, nothing is read. Runs until cancelled.
+        """
+        if MessageBus is None:
+            return
+        bus = None
+        try:
+            while True:
+                await asyncio.sleep(BLUEZ_REFRESH_INTERVAL or 1)
+                if not BLUEZ_REFRESH_INTERVAL:
+                    continue
+                try:
+                    if bus is None or not bus.connected:
+                        bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+                    self.update_bluez_devices(await bluez_objects(bus))
+                except Exception as e:
+                    logger.warning("Could not read the BlueZ device objects: %s", e)
+        finally:
+            if bus is not None:
+                bus.disconnect()
+
+    def connect_target(self, device_address, adapter):
+        """
+        Returns what to connect to through `adapter`: the BLEDevice the scanner found if it was seen on
+        that adapter, else the device object BlueZ has under the adapter, else the address (bleak then
+        scans for the device on that adapter before connecting).
+        """
+        target = self.registry.connect_target(device_address, adapter)
+        if isinstance(target, str):
+            return self.bluez_devices.get((adapter, device_address), target)
+        return target
 
     async def find_devices(self):
         """
@@ -100,42 +2577,86 @@ class SensorGateway:
         Stores devices matching the manufacturer ID.
         """
 
-        print(f"Scanning for nearby BLE devices...")
+        logger.info("Scanning for nearby BLE devices...")
 
-        discovered_devices_and_advertisement_data = await BleakScanner.discover(return_adv=True)
-        self.devices = []  # Reset the device list before scanning
+        scan_start = time.monotonic()
+        discovered_devices_and_advertisement_data = await BleakScanner.discover(return_adv=True, bluez={"adapter": self.scan_adapter})
+        SCAN_DURATION.observe(time.monotonic() - scan_start)
 
         for device, adv_data in discovered_devices_and_advertisement_data.values():
             device_name = device.name or "Unknown"
             device_address = device.address
-            rssi = device.rssi  # Signal strength (in dBm)
+            rssi = adv_data.rssi  # Signal strength (in dBm)
             service_uuids = adv_data.service_uuids  # List of advertised service UUIDs
             manufacturer_data = adv_data.manufacturer_data  # Manufacturer-specific data
             raw_data = adv_data  # Raw advertisement data
 
-            manufacturer_key = next(iter(manufacturer_data), None) if manufacturer_data else None
+            # Log detailed device information for all devices
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Found device: %s (%s)", device_name, device_address)
+                logger.debug("   - RSSI: %s dBm", rssi)
+                logger.debug("   - Advertised Services: %s", service_uuids if service_uuids else 'None')
+                if manufacturer_data:
+                    logger.debug("   - Manufacturer Data: %s", manufacturer_data)
+                if raw_data:
+                    logger.debug("   - Raw Advertisement Data: %s", raw_data)
 
-            # Print detailed device information for all devices
-            print(f"Found device: {device_name} ({device_address})")
-            print(f"   - RSSI: {rssi} dBm")
-            print(f"   - Advertised Services: {service_uuids if service_uuids else 'None'}")
-            if manufacturer_data:
-                print(f"   - Manufacturer Data: {manufacturer_data}")
-            if raw_data:
-                print(f"   - Raw Advertisement Data: {raw_data}")
-
-            if manufacturer_key == self.manufacturer_id:
-                self.devices.append((device_name, device_address))
-                print(f"Added {device_name} ({device_address}) to the device list.")
+            if self.registry.update(device, adv_data, self.scan_adapter):
+                self.session_engine.scheduler.record_rssi(self.scan_adapter, device_address, rssi)
+                logger.info("Added %s (%s) to the device list.", device_name, device_address)
 
+        self.registry.expire(keep=self.session_engine.connected)
 
         if not self.devices:
-            print(f"No devices Manufacturer ID '{self.manufacturer_id}' found.")
+            logger.info("No devices Manufacturer ID '%s' found.", self.manufacturer_id)
         else:
-            print(f"Devices advertising Manufacturer ID '{self.manufacturer_id}': {self.devices}")
-
+            logger.info("Devices advertising Manufacturer ID '%s': %s", self.manufacturer_id, self.devices)
 
-    def notification_handler(self, data, device_info, char_uuid, first_temp_ignored):
+    def on_advertisement(self, device, adv_data):
+        """Detection callback of the background scanner; keeps the registry up to date."""
+        ADVERTISEMENTS.inc()
+        is_new = device.address not in self.registry.entries
+        if not self.registry.update(device, adv_data, self.scan_adapter):
+            return
+        self.session_engine.scheduler.record_rssi(self.scan_adapter, device.address, adv_data.rssi)
+        if is_new:
+            logger.info("Added %s (%s) to the device list (RSSI %s dBm).", device.name or 'Unknown', device.address, adv_data.rssi)
+
+    def create_scanner(self):
+        """Creates the background BleakScanner, filtering on the manufacturer ID in passive mode."""
+        if SCANNING_MODE == "passive":
+            from bleak.assigned_numbers import AdvertisementDataType
+            from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
+
+            manufacturer_prefix = self.manufacturer_id.to_bytes(2, byteorder='little')
+            or_patterns = [OrPattern(0, AdvertisementDataType.MANUFACTURER_SPECIFIC_DATA, manufacturer_prefix)]
+            return BleakScanner(detection_callback=self.on_advertisement, scanning_mode="passive",
+                                bluez={"or_patterns": or_patterns, "adapter": self.scan_adapter})
+        return BleakScanner(detection_callback=self.on_advertisement, bluez={"adapter": self.scan_adapter})
+
+    async def run_scanner(self):
+        """
+        Scans continuously in the background, applying advertisements to the registry as they arrive
+        and expiring devices that went silent. Runs until cancelled.
+        """
+        self.scanner = self.create_scanner()
+        await self.scanner.start()
+        logger.info("Background BLE scanner started on %s.", self.scan_adapter)
+        try:
+            while True:
+                await asyncio.sleep(1)
+                self.registry.expire(keep=self.session_engine.connected)
+        finally:
+            await self.scanner.stop()
+            logger.info("Background BLE scanner stopped.")
+
+    async def restart_scanner(self, previous):
+        """Stops the scanner running in the `previous` task and scans again, e.g. with a changed scanning mode."""
+        previous.cancel()
+        await asyncio.gather(previous, return_exceptions=True)
+        await self.run_scanner()
+
+    def notification_handler(self, data, device_info, char_uuid, seen_characteristics):
         """
         Handles incoming BLE notifications and processes sensor data.
 
@@ -143,174 +2664,1074 @@ class SensorGateway:
             data (bytes): The received notification data.
             device_info (tuple): Tuple containing (device_name, device_address).
             char_uuid (str): The UUID of the characteristic that sent the notification.
+            seen_characteristics (set): UUIDs that already notified on the current connection.
         """
+        arrival = time.monotonic()
         device_name, device_address = device_info
-        byte_data = ' '.join(f'0x{byte:02X}' for byte in data)  # Convert to hexadecimal byte representation
-        print(f"Received data from {char_uuid} on {device_name} ({device_address}): {byte_data}")
+        self.session_engine.record_sample(device_address)
+        self.registry.touch(device_address)
+        NOTIFICATIONS.inc((device_address, self.characteristic_names.get(char_uuid, char_uuid)))
+        if logger.isEnabledFor(logging.DEBUG):
+            byte_data = ' '.join(f'0x{byte:02X}' for byte in data)  # Convert to hexadecimal byte representation
+            logger.debug("Received data from %s on %s (%s): %s", char_uuid, device_name, device_address, byte_data)
+
+        decoder = self.decoders.get(char_uuid)
+        if decoder is None:
+            return
 
-        message, topic = None, None
+        if decoder.skip_first and char_uuid not in seen_characteristics:
+            seen_characteristics.add(char_uuid)
+            return
 
+        decode_start = time.perf_counter()
         try:
-            # Process temperature data
-            if char_uuid == self.characteristic_uuids.get("TEMPERATURE"):
-                if first_temp_ignored[0]:  # Ignore first temperature value
-
-                    timestamp = int.from_bytes(data[0:2], byteorder='little')
-                    temperature = int.from_bytes(data[2:4], byteorder='little') / 10.0
-                    message = {"device": device_name, "address": device_address, "temperature": temperature, "timestamp": timestamp}
-                    topic = f"{device_name}/temp/{device_address}"
-
-                first_temp_ignored[0] = True
-                
-
-            # Process battery data
-            elif char_uuid == self.characteristic_uuids.get("BATTERY"):
-                timestamp = int.from_bytes(data[0:2], byteorder='little')
-                battery_percentage = int.from_bytes(data[2:4], byteorder='little') / 10.0
-                voltage = int.from_bytes(data[4:6], byteorder='little') / 1000.0
-                current = int.from_bytes(data[6:8], byteorder='little') / 10.0
-                state = int.from_bytes(data[8:], byteorder='little') / 1.0
-
-                 # Map status byte to human-readable string
-                status_map = {
-                    0: "Low battery",
-                    1: "Discharging",
-                    2: "Plugged, not charging",
-                    3: "Charging",
-                    4: "Unknown"
-                }
-                status = status_map.get(state, "Unknown")  # Default to "Unknown" if status byte is not in the map
-                
-                message = {"device": device_name, "address": device_address, "battery": battery_percentage, "voltage": voltage, "current": current, "status": status, "timestamp": timestamp}
-                topic = f"{device_name}/battery/{device_address}"
-
-            elif char_uuid == self.characteristic_uuids.get("ACCELEROMETER_EVENT"):
-                timestamp = int.from_bytes(data[0:2], byteorder='little')
-                event_int = int.from_bytes(data[2:3], byteorder='little')
-                steps = int.from_bytes(data[3:5], byteorder='little')
-
-                event_map = {
-                    0: "No event",
-                    1: "Orientation top right",
-                    2: "Orientation bottom right",
-                    3: "Orientation bottom left",
-                    4: "Orientation top left",
-                    5: "Orientation up",
-                    6: "Orientation bottom",
-                    8: "Tilt",
-                    16: "Free fall",
-                    32: "Single tap",
-                    64: "Double tap",
-                    128: "Wake up"
-                }
-
-                event = event_map.get(event_int, "Unknown")
-                message = {"device": device_name, "address": device_address, "event": event, "steps": steps}
-                topic = f"{device_name}/acc_event/{device_address}"
-
-            elif char_uuid == self.characteristic_uuids.get("SWITCH"):
-                timestamp = int.from_bytes(data[0:2], byteorder='little')
-                switch_int = int.from_bytes(data[2:3], byteorder='little')
-
-                switch_map = {
-                    0: "OFF",
-                    1: "ON"
-                }
-
-                switch = switch_map.get(switch_int, "Unknown")
-                message = {"device": device_name, "address": device_address, "switch": switch}
-                topic = f"{device_name}/switch/{device_address}"
-
-            if message and topic:
-                print(f"Publishing to {topic}: {message}")
-                asyncio.create_task(self.mqtt_publisher.publish_message(topic, json.dumps(message)))
-
+            reading = decoder.decode(data)
+            if self.poll_scheduler.active:
+                self.poll_scheduler.record(device_address, char_uuid, reading)
+            counter = reading.get("timestamp")
+            if counter is not None:
+                reading_time = self.clocks.time(device_address, counter, arrival)
+            else:
+                reading_time = arrival + time.time() - time.monotonic()
+            if self.history is not None:
+                self.history.record(device_address, decoder.stream, reading, reading_time)
+            if self.alert_engine.windows:
+                self.alert_engine.record(device_name, device_address, reading, reading_time)
+            message = {"device": device_name, "address": device_address}
+            message.update(reading)
+            message["time"] = round(reading_time, 3)
+            topic = self.topics.get((device_name, device_address, decoder.stream))
+            if topic is None:
+                topic = self.topics[(device_name, device_address, decoder.stream)] = f"{device_name}/{decoder.stream}/{device_address}"
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Processing for %s: %s", topic, message)
+            rule = self.stream_rules.get(char_uuid)
+            if rule is None:
+                self.publish_pipeline.submit(topic, message)
+            else:
+                rule.process(topic, message, arrival, self.publish_pipeline.submit)
+            DECODE_TIME.observe(time.perf_counter() - decode_start)
 
         except Exception as e:
-            print(f"Error processing notification from {char_uuid}: {e}")
+            logger.warning("Error processing notification from %s: %s", char_uuid, e)
 
+    def cached_characteristics(self, client, device_address):
+        """
+        Returns the characteristic UUIDs to subscribe to on a device, discovering them on first connection.
 
-    async def read_data_from_device(self, device_name, device_address):
-        """Connects to a BLE device, subscribes to notifications, listens for a short time, then moves on."""
-        try:
-            async with BleakClient(device_address) as client:
-                if not client.is_connected:
-                    print(f"Failed to connect to {device_name} ({device_address})")
-                    return
+        The result of the first service discovery is cached per address so that reconnects only
+        subscribe to characteristics the device actually exposes.
+        """
+        if device_address not in self.gatt_cache:
+            wanted = list(self.characteristic_uuids.values())
+            services = client.services
+            if services is not None:
+                wanted = [char_uuid for char_uuid in wanted if services.get_characteristic(char_uuid) is not None]
+            self.gatt_cache[device_address] = wanted
+        return self.gatt_cache[device_address]
+
+    async def subscribe_notifications(self, client, device_name, device_address):
+        """Subscribes to all known characteristics of a connected device and returns the subscribed UUIDs."""
+        seen_characteristics = set()  # Track characteristics whose first value may need to be ignored
+
+        # A plain function: bleak would run a coroutine callback as a new task for every notification
+        def on_notification(sender, data):
+            self.notification_handler(data, (device_name, device_address), sender.uuid, seen_characteristics)
+
+        subscribed = []
+        for char_uuid in self.cached_characteristics(client, device_address):
+            try:
+                await client.start_notify(char_uuid, functools.partial(on_notification))
+                subscribed.append(char_uuid)
+            except Exception as e:
+                logger.warning("Failed to subscribe to %s on %s: %s", char_uuid, device_name, e)
+        return subscribed
 
-                print(f"Connected to {device_name} ({device_address})")
+    async def read_data_from_device(self, device_name, device_address, adapter=None, listen_time=None):
+        """
+        Connects to a BLE device, subscribes to notifications, listens for `listen_time` seconds
+        (LISTEN_WINDOW by default), then moves on.
 
-                first_temp_ignored = [False]  # Track if the first temperature value has been ignored
+        Returns:
+            bool: True if the device was connected and listened to.
+        """
+        adapter = adapter or self.scan_adapter
+        scheduler = self.session_engine.scheduler
+        try:
+            connect_start = time.monotonic()
+            async with BleakClient(self.connect_target(device_address, adapter), bluez={"adapter": adapter}) as client:
+                if not client.is_connected:
+                    CONNECT_FAILURES.inc((device_address,))
+                    scheduler.record_result(adapter, device_address, False)
+                    logger.warning("Failed to connect to %s (%s)", device_name, device_address)
+                    return False
 
-                async def on_notification(sender, data):
-                    self.notification_handler(data, (device_name, device_address), sender.uuid, first_temp_ignored)
+                CONNECT_LATENCY.observe(time.monotonic() - connect_start)
+                scheduler.record_result(adapter, device_address, True)
+                logger.info("Connected to %s (%s)", device_name, device_address)
 
-                # Subscribe to characteristics
-                for char_uuid in self.characteristic_uuids.values():
-                    try:
-                        await client.start_notify(char_uuid, functools.partial(on_notification))
-                    except Exception as e:
-                        print(f"Failed to subscribe to {char_uuid} on {device_name}: {e}")
+                subscribed = await self.subscribe_notifications(client, device_name, device_address)
+                if not subscribed:
+                    logger.warning("No notifications subscribed on %s (%s), disconnecting", device_name, device_address)
+                    return False
 
-                await asyncio.sleep(10)  # Listen for 5 seconds
+                await asyncio.sleep(LISTEN_WINDOW if listen_time is None else listen_time)
 
                 # Unsubscribe from characteristics
-                for char_uuid in self.characteristic_uuids:
+                for char_uuid in subscribed:
                     try:
                         await client.stop_notify(char_uuid)
                     except Exception as e:
-                        print(f"Error unsubscribing from {char_uuid}: {e}")
+                        logger.warning("Error unsubscribing from %s: %s", char_uuid, e)
+            return True
 
         except Exception as e:
-            print(f"Error with {device_name} ({device_address}): {e}")
+            CONNECT_FAILURES.inc((device_address,))
+            scheduler.record_result(adapter, device_address, False)
+            logger.error("Error with %s (%s): %s", device_name, device_address, e)
+            return False
+
+    async def stream_from_device(self, device_name, device_address):
+        """
+        Keeps a long-lived connection to a BLE device and streams its notifications.
+
+        Subscriptions stay active for as long as the link is up, or until the connection makes way for
+        a device waiting for a slot (see STREAM_ROTATE_INTERVAL). When the link drops, or nothing could
+        be subscribed to, the device is reconnected with exponential backoff (with jitter) until the
+        task is cancelled. Devices without any of the characteristics are retried every RECONNECT_BACKOFF_MAX seconds.
+        """
+        backoff = RECONNECT_BACKOFF_MIN
+        while True:
+            disconnected = asyncio.Event()
+            # Restrict discovery to the PROTEUS service once the device's characteristics are known
+            services = [self.service_uuid] if device_address in self.gatt_cache else None
+            scheduler = self.session_engine.scheduler
+            adapter = None
+            rotated = False
+            if not STREAM_ROTATE_INTERVAL and (scheduler.waiters or scheduler.choose(device_address) is None):
+                logger.warning("No free connection slot for %s (%s): it waits until a connection ends. Raise "
+                               "MAX_CONNECTIONS, add adapters or set STREAM_ROTATE_INTERVAL.", device_name, device_address)
+            try:
+                # Only hold a connection slot while connected, so backing-off devices don't starve others
+                async with scheduler.slot(device_address) as adapter:
+                    target = self.connect_target(device_address, adapter)
+                    connect_start = time.monotonic()
+                    async with BleakClient(target, services=services, disconnected_callback=lambda _: disconnected.set(), bluez={"adapter": adapter}) as client:
+                        if not client.is_connected:
+                            raise ConnectionError("connection not established")
+
+                        CONNECT_LATENCY.observe(time.monotonic() - connect_start)
+                        scheduler.record_result(adapter, device_address, True)
+                        logger.info("Connected to %s (%s) via %s, streaming notifications", device_name, device_address, adapter)
+                        self.session_engine.connected.add(device_address)
+                        try:
+                            subscribed = await self.subscribe_notifications(client, device_name, device_address)
+                            if subscribed:
+                                backoff = RECONNECT_BACKOFF_MIN
+                                rotated = await self.hold_connection(device_address, disconnected)
+                        finally:
+                            self.session_engine.connected.discard(device_address)
+                        if rotated:
+                            logger.info("Disconnected %s (%s) to make way for a waiting device", device_name, device_address)
+                        elif subscribed:
+                            CONNECT_FAILURES.inc((device_address,))
+                            logger.warning("Connection to %s (%s) lost", device_name, device_address)
+                        elif not self.gatt_cache.get(device_address):
+                            # None of the characteristics exist on the device: retry rarely, in case it is reflashed
+                            backoff = RECONNECT_BACKOFF_MAX
+                            logger.warning("%s (%s) has none of the characteristics, disconnecting", device_name, device_address)
+                        else:
+                            logger.warning("No notifications subscribed on %s (%s), disconnecting", device_name, device_address)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                CONNECT_FAILURES.inc((device_address,))
+                if adapter is not None:
+                    scheduler.record_result(adapter, device_address, False)
+                logger.error("Error with %s (%s): %s", device_name, device_address, e)
+
+            if rotated:
+                continue  # Wait in line for the next free slot
+            delay = backoff * random.uniform(0.5, 1.0)
+            logger.info("Reconnecting to %s (%s) in %.1fs", device_name, device_address, delay)
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+    async def hold_connection(self, device_address, disconnected):
+        """
+        Waits until the link drops and returns False, or returns True as soon as the connection
+        should make way for a device waiting for a slot (see AdapterScheduler.rotate()).
+        """
+        scheduler = self.session_engine.scheduler
+        connected_since = asyncio.get_event_loop().time()
+        waiter = asyncio.ensure_future(disconnected.wait())
+        try:
+            while True:
+                done, _ = await asyncio.wait((waiter,), timeout=1)
+                if done:
+                    return False
+                if scheduler.rotate(device_address, connected_since):
+                    return True
+        finally:
+            waiter.cancel()
 
     async def read_data_from_all_devices(self):
-        """Connects to each discovered BLE device and subscribes to notifications."""
+        """Connects to all discovered BLE devices concurrently and subscribes to notifications."""
         if not self.devices:
-            print("No devices found. Please run `find_devices()` first.")
+            logger.warning("No devices found. Please run `find_devices()` first.")
             return
 
-        for device_name, device_address in self.devices:
+        await self.session_engine.run_all(self.devices)
+
+
+async def bluez_objects(bus):
+    """Returns BlueZ's D-Bus objects as {object path: {interface: {property: value}}}."""
+    reply = await bus.call(Message(destination="org.bluez", path="/", interface="org.freedesktop.DBus.ObjectManager",
+                                   member="GetManagedObjects"))
+    if reply.message_type == MessageType.ERROR:
+        raise ConnectionError(f"{reply.error_name}: {reply.body}")
+    return {path: {interface: {name: getattr(value, "value", value) for name, value in properties.items()}
+                   for interface, properties in interfaces.items()}
+            for path, interfaces in reply.body[0].items()}
+
+
+class GatewaySnapshot:
+    """
+    Crash-safe snapshot of the device registry, the GATT cache and the adapters' RSSI per device in
+    `path` (JSON, replaced atomically), written every SNAPSHOT_INTERVAL seconds and at shutdown.
+
+    On start, the devices of a snapshot younger than SNAPSHOT_MAX_AGE are registered right away, so
+    their sessions start in parallel without waiting for advertisements while the background scan
+    runs. Devices that BlueZ still knows are connected through their D-Bus object, without a scan.
+    """
+    VERSION = 1
+
+    def __init__(self, gateway, path, interval=None):
+        self.gateway = gateway
+        self.path = path
+        self.interval = interval or SNAPSHOT_INTERVAL
+
+    def save(self):
+        gateway = self.gateway
+        now = time.monotonic()
+        snapshot = {
+            "version": self.VERSION,
+            "time": time.time(),
+            "manufacturer_id": gateway.manufacturer_id,
+            "service_uuid": gateway.service_uuid,
+            "devices": [{"name": entry.name, "address": entry.address, "rssi": entry.rssi, "adapter": entry.adapter,
+                         "age": now - entry.last_seen} for entry in gateway.registry.entries.values()],
+            "gatt_cache": gateway.gatt_cache,
+            "rssi": [[adapter, address, rssi] for (adapter, address), rssi in gateway.session_engine.scheduler.rssi.items()],
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Returns the saved snapshot, or None if there is none or it cannot be used."""
+        try:
+            with open(self.path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable snapshot %s: %s", self.path, e)
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != self.VERSION:
+            return None
+        required = ("time", "manufacturer_id", "service_uuid", "devices", "gatt_cache", "rssi")
+        if any(key not in snapshot for key in required):
+            logger.warning("Ignoring incomplete snapshot %s", self.path)
+            return None
+        return snapshot
+
+    def restore(self):
+        """Restores the saved state into the gateway; returns the number of devices registered."""
+        snapshot = self.load()
+        if snapshot is None:
+            return 0
+        gateway = self.gateway
+        if snapshot["service_uuid"] == gateway.service_uuid:
+            wanted = set(gateway.characteristic_uuids.values())
+            for address, characteristics in snapshot["gatt_cache"].items():
+                gateway.gatt_cache.setdefault(address, [char_uuid for char_uuid in characteristics if char_uuid in wanted])
+        for adapter, address, rssi in snapshot["rssi"]:
+            if adapter in gateway.adapters:
+                gateway.session_engine.scheduler.record_rssi(adapter, address, rssi)
+
+        age = time.time() - snapshot["time"]
+        if snapshot["manufacturer_id"] != gateway.manufacturer_id or not 0 <= age <= SNAPSHOT_MAX_AGE:
+            return 0
+        restored = 0
+        for device in snapshot["devices"]:
+            if device["age"] + age > DEVICE_EXPIRY:
+                continue
+            # Prefer the adapter the device was last seen on, if BlueZ still has it there
+            adapters = [device["adapter"]] + [adapter for adapter in gateway.adapters if adapter != device["adapter"]]
+            adapter = next((adapter for adapter in adapters if (adapter, device["address"]) in gateway.bluez_devices), None)
+            if gateway.registry.restore(device["name"], device["address"], device["rssi"],
+                                        gateway.bluez_devices.get((adapter, device["address"])), adapter):
+                restored += 1
+        logger.info("Restored %d devices from the snapshot of %.0fs ago", restored, age)
+        return restored
+
+    async def run(self):
+        """Saves the snapshot every `interval` seconds, and once more when cancelled."""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    self.save()
+                except OSError as e:
+                    logger.error("Error saving the snapshot to %s: %s", self.path, e)
+        finally:
             try:
-                print(f"Connecting to {device_name} ({device_address})...")
-                await self.read_data_from_device(device_name, device_address)
+                self.save()
+            except OSError as e:
+                logger.error("Error saving the snapshot to %s: %s", self.path, e)
+
+
+class WorkerSupervisor:
+    """
+    Runs the BLE worker processes of sharded mode and forwards their messages to the publisher.
+
+    Worker N runs `target(N, shards, messages)` in its own process and only handles the devices
+    that shard_of() assigns to it. A worker that exits is restarted after an exponential backoff,
+    which resets once the worker has stayed up for WORKER_RESTART_BACKOFF_MAX seconds. Workers are
+    started with the "spawn" method so that they do not inherit the publisher's threads.
+    """
+    def __init__(self, shards, target=None, context=None):
+        self.shards = shards
+        self.target = target or run_worker
+        self.context = context or multiprocessing.get_context("spawn")
+        self.messages = self.context.Queue(WORKER_QUEUE_SIZE)
+        self.processes = {}  # shard -> Process
+        self.started = {}  # shard -> monotonic time the worker was last started
+        self.failures = {}  # shard -> consecutive early exits
+        self.restart_at = {}  # shard -> monotonic time of the pending restart
+        self.stopping = False
+
+    def start_worker(self, shard):
+        process = self.context.Process(target=self.target, args=(shard, self.shards, self.messages),
+                                       name=f"BleGateway-worker{shard}", daemon=True)
+        process.start()
+        self.processes[shard] = process
+        self.started[shard] = time.monotonic()
+        logger.info("Started worker %d/%d (pid %d)", shard, self.shards, process.pid)
+
+    def start(self):
+        for shard in range(self.shards):
+            self.start_worker(shard)
+
+    def alive(self):
+        return sum(process.is_alive() for process in self.processes.values())
+
+    def check(self):
+        """Schedules the restart of exited workers and starts those whose backoff elapsed."""
+        now = time.monotonic()
+        for shard, process in self.processes.items():
+            if shard in self.restart_at:
+                if now >= self.restart_at[shard]:
+                    del self.restart_at[shard]
+                    WORKER_RESTARTS.inc((shard,))
+                    self.start_worker(shard)
+            elif not process.is_alive():
+                process.join()
+                if now - self.started[shard] >= WORKER_RESTART_BACKOFF_MAX:
+                    self.failures[shard] = 0
+                self.failures[shard] = self.failures.get(shard, 0) + 1
+                delay = min(2 ** (self.failures[shard] - 1), WORKER_RESTART_BACKOFF_MAX)
+                self.restart_at[shard] = now + delay
+                logger.error("Worker %d exited with code %s, restarting in %ds", shard, process.exitcode, delay)
+
+    async def supervise(self, period=1):
+        """Checks the workers every `period` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(period)
+            self.check()
+
+    def receive(self, limit=100):
+        """Blocks for up to a second for messages from the workers and returns up to `limit` of them."""
+        try:
+            received = [self.messages.get(timeout=1)]
+        except queue.Empty:
+            return []
+        with contextlib.suppress(queue.Empty):
+            while len(received) < limit:
+                received.append(self.messages.get_nowait())
+        return received
+
+    async def forward(self, publisher):
+        """Publishes the workers' messages until stop() has been called and the queue is empty."""
+        loop = asyncio.get_event_loop()
+        while True:
+            received = await loop.run_in_executor(None, self.receive)
+            if not received and self.stopping:
+                return
+            for topic, message in received:
+                try:
+                    await publisher.publish_message(topic, message)
+                except Exception as e:
+                    logger.error("Error publishing message from a worker to %s: %s", topic, e)
+
+    async def stop(self, timeout=10):
+        """Asks the workers to shut down (SIGTERM), waiting up to `timeout` seconds before killing them."""
+        self.stopping = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        while self.alive() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for shard, process in self.processes.items():
+            if process.is_alive():
+                logger.warning("Worker %d did not stop in time, killing it", shard)
+                process.kill()
+            process.join()
+
+
+def config_number(minimum=None, maximum=None, integer=False, positive=False):
+    """Validator for numeric settings; `positive` ones must be greater than 0."""
+    def validate(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"expected a number, got {value!r}")
+        if integer:
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError(f"expected an integer, got {value!r}")
+            value = int(value)
+        if minimum is not None and value < minimum:
+            raise ValueError(f"must be at least {minimum}")
+        if positive and value <= 0:
+            raise ValueError("must be greater than 0")
+        if maximum is not None and value > maximum:
+            raise ValueError(f"must be at most {maximum}")
+        return value
+    return validate
+
+
+def config_choice(*choices):
+    def validate(value):
+        if value not in choices:
+            raise ValueError(f"expected one of {', '.join(map(repr, choices))}, got {value!r}")
+        return value
+    return validate
+
+
+def config_string(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"expected a non-empty string, got {value!r}")
+    return value
+
+
+def config_bool(value):
+    if not isinstance(value, bool):
+        raise ValueError(f"expected true or false, got {value!r}")
+    return value
+
+
+def config_uuid(value):
+    try:
+        return str(uuid.UUID(config_string(value)))
+    except ValueError:
+        raise ValueError(f"expected a UUID, got {value!r}") from None
+
+
+def config_mapping(validate_value):
+    """Validator for a table of name -> value."""
+    def validate(value):
+        if not isinstance(value, dict):
+            raise ValueError(f"expected a table, got {value!r}")
+        return {config_string(name): validate_value(item) for name, item in value.items()}
+    return validate
+
+
+def config_adapters(value):
+    if value is None:
+        return None
+    if not isinstance(value, list) or not value or not all(isinstance(name, str) and name.startswith("hci") and name[3:].isdigit() for name in value):
+        raise ValueError(f"expected a list of adapter names such as [\"hci0\"], got {value!r}")
+    return value
+
+
+def config_stream_rule(value):
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a table, got {value!r}")
+    unknown = set(value) - {"deadband", "on_change", "heartbeat", "window"}
+    if unknown:
+        raise ValueError(f"unknown options {', '.join(sorted(unknown))}")
+    rule = {}
+    if "deadband" in value:
+        rule["deadband"] = config_mapping(config_number(minimum=0))(value["deadband"])
+    if "on_change" in value:
+        if not isinstance(value["on_change"], list):
+            raise ValueError(f"on_change: expected a list of field names, got {value['on_change']!r}")
+        rule["on_change"] = [config_string(field) for field in value["on_change"]]
+    for option in ("heartbeat", "window"):
+        if value.get(option) is not None:
+            rule[option] = config_number(minimum=0)(value[option])
+    return rule
+
+
+def config_alert_rule(value):
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a table, got {value!r}")
+    AlertRule("rule", value)
+    return value
+
+
+def config_payload_format(value):
+    try:
+        PayloadEncoder(value)
+    except (ValueError, ImportError) as e:
+        raise ValueError(str(e)) from None
+    return value
+
+
+# Settings that can be overridden at runtime (see ConfigManager), with their validators
+CONFIG_SCHEMA = {
+    "RUNTIME": config_number(minimum=0),
+    "SCAN_INTERVAL": config_number(minimum=1),
+    "DEVICE_EXPIRY": config_number(minimum=1),
+    "SCANNING_MODE": config_choice("active", "passive"),
+    "MAX_CONNECTIONS": config_number(minimum=1, integer=True),
+    "ADAPTERS": config_adapters,
+    "BLUEZ_REFRESH_INTERVAL": config_number(minimum=0),
+    "WORKER_PROCESSES": config_number(minimum=0, integer=True),
+    "WORKER_QUEUE_SIZE": config_number(minimum=1, integer=True),
+    "WORKER_RESTART_BACKOFF_MAX": config_number(minimum=1),
+    "LISTEN_WINDOW": config_number(positive=True),
+    "PERSISTENT_CONNECTIONS": config_bool,
+    "POLL_LISTEN_MIN": config_number(positive=True),
+    "POLL_LISTEN_MAX": config_number(positive=True),
+    "POLL_INTERVAL_MIN": config_number(minimum=0),
+    "POLL_INTERVAL_MAX": config_number(minimum=0),
+    "POLL_SAMPLES": config_number(minimum=1),
+    "POLL_CHANGES": config_number(minimum=1),
+    "LATENCY_BUDGETS": config_mapping(config_number(minimum=0)),
+    "STREAM_ROTATE_INTERVAL": config_number(minimum=0),
+    "RECONNECT_BACKOFF_MIN": config_number(minimum=0),
+    "RECONNECT_BACKOFF_MAX": config_number(minimum=0),
+    "STMICROELECTRONICS_MANUFACTURER_KEY": config_number(minimum=0, maximum=0xFFFF, integer=True),
+    "SERVICE_UUID": config_uuid,
+    "CHARACTERISTIC_UUIDS": config_mapping(config_uuid),
+    "TIMESTAMP_TICK": config_number(minimum=1e-6),
+    "TIMESTAMP_MAX_DRIFT": config_number(minimum=0, maximum=0.5),
+    "TIMESTAMP_WINDOW": config_number(minimum=2, integer=True),
+    "TIMESTAMP_RESET_ERROR": config_number(minimum=0.1),
+    "STREAM_PROCESSING": config_mapping(config_stream_rule),
+    "ALERT_RULES": config_mapping(config_alert_rule),
+    "ALERT_TOPIC": config_string,
+    "ALERT_INTERVAL": config_number(minimum=0),
+    "ALERT_HOLDOFF": config_number(minimum=0),
+    "LOG_LEVEL": config_choice("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"),
+    "LOG_RATE_LIMIT": config_number(minimum=1, integer=True),
+    "LOG_RATE_INTERVAL": config_number(minimum=0),
+    "METRICS_HOST": config_string,
+    "METRICS_PORT": config_number(minimum=0, maximum=65535, integer=True),
+    "METRICS_TOPIC": config_string,
+    "METRICS_INTERVAL": config_number(minimum=0),
+    "DEVICE_CERT": config_string,
+    "DEVICE_KEY": config_string,
+    "ROOT_CA": config_string,
+    "ENDPOINT": config_string,
+    "PUBLISH_BACKEND": config_choice("mqtt", "ipc"),
+    "IPC_DESTINATION": config_choice(*GreengrassIpcPublisher.DESTINATIONS),
+    "IPC_MAX_IN_FLIGHT": config_number(minimum=1, integer=True),
+    "PUBLISH_BATCH_SIZE": config_number(minimum=1, maximum=65535, integer=True),  # The packed format counts readings in 16 bits
+    "PUBLISH_FLUSH_INTERVAL": config_number(minimum=0),
+    "PUBLISH_QUEUE_SIZE": config_number(minimum=1, integer=True),
+    "PUBLISH_OVERFLOW_POLICY": config_choice("drop_oldest", "drop_newest"),
+    "PAYLOAD_FORMAT": config_payload_format,
+    "BUFFER_DIR": config_string,
+    "BUFFER_SEGMENT_BYTES": config_number(minimum=1, integer=True),
+    "BUFFER_MAX_BYTES": config_number(minimum=1, integer=True),
+    "BUFFER_DRAIN_RATE": config_number(minimum=1, integer=True),
+    "MQTT_MAX_QUEUED_MESSAGES": config_number(minimum=1, integer=True),  # paho treats 0 as unlimited
+    "HISTORY_SIZE": config_number(minimum=0, integer=True),
+    "HISTORY_MAX_SERIES": config_number(minimum=1, integer=True),
+    "HISTORY_PERSIST": config_bool,
+    "HISTORY_DIR": config_string,
+    "SNAPSHOT_FILE": config_string,
+    "SNAPSHOT_INTERVAL": config_number(minimum=0),
+    "SNAPSHOT_MAX_AGE": config_number(minimum=0),
+}
+
+# Settings only read at startup; changing them while running takes effect at the next restart
+STARTUP_SETTINGS = ("RUNTIME", "ADAPTERS", "WORKER_PROCESSES", "WORKER_QUEUE_SIZE", "PERSISTENT_CONNECTIONS", "PUBLISH_QUEUE_SIZE",
+                    "PUBLISH_BACKEND", "IPC_MAX_IN_FLIGHT", "BUFFER_DIR", "BUFFER_SEGMENT_BYTES", "BUFFER_MAX_BYTES", "MQTT_MAX_QUEUED_MESSAGES",
+                    "HISTORY_SIZE", "HISTORY_MAX_SERIES", "HISTORY_PERSIST", "HISTORY_DIR", "SNAPSHOT_FILE", "SNAPSHOT_INTERVAL")
+
+# Settings ranges that must not be inverted, as (lower bound, upper bound) pairs
+CONFIG_RANGES = (("POLL_LISTEN_MIN", "POLL_LISTEN_MAX"), ("POLL_INTERVAL_MIN", "POLL_INTERVAL_MAX"),
+                 ("RECONNECT_BACKOFF_MIN", "RECONNECT_BACKOFF_MAX"))
+
+
+class ConfigManager:
+    """
+    Validated runtime configuration with hot reload.
+
+    The settings are the module constants listed in CONFIG_SCHEMA. Two sources are layered over
+    their defaults: the component configuration from the Greengrass recipe or deployment (read
+    over IPC when awsiotsdk is installed) and then CONFIG_FILE. Whenever a source changes, the
+    merged settings are validated as a whole; an invalid update is logged and rejected, keeping
+    the running configuration. Otherwise the changed settings are assigned to the module constants
+    and each subscriber whose settings changed is called with a dict of those changes, so only the
+    affected subsystems reconfigure. If a subscriber raises, the update is rejected as well: the
+    previous values are restored and passed back to the subscribers already called. STARTUP_SETTINGS
+    only change at the next restart.
+    """
+    SOURCES = ("component", "file")  # In increasing order of precedence
+    IGNORED_KEYS = ("accessControl",)  # Component configuration keys used by Greengrass itself
+
+    def __init__(self, path=None, schema=None, namespace=None):
+        self.path = CONFIG_FILE if path is None else path
+        self.schema = CONFIG_SCHEMA if schema is None else schema
+        self.namespace = globals() if namespace is None else namespace
+        self.defaults = {name: self.namespace[name] for name in self.schema}
+        self.values = dict(self.defaults)
+        self.sources = {}  # source name -> raw settings
+        self.subscribers = []  # (setting names, callback)
+        self.loaded = False
+        self.file_mtime = None
+        self.loop = None
+        self.ipc_client = None
+
+    def subscribe(self, names, callback):
+        """Calls callback(changes) with the changed settings whenever one of the settings in `names` changes."""
+        self.subscribers.append((tuple(names), callback))
+
+    def merge(self):
+        """Layers the sources over the defaults and validates the result; raises ValueError if invalid."""
+        values = dict(self.defaults)
+        for source in self.SOURCES:
+            for name, value in self.sources.get(source, {}).items():
+                if name not in self.schema:
+                    continue  # Reported when the source is loaded
+                try:
+                    values[name] = self.schema[name](value)
+                except ValueError as e:
+                    raise ValueError(f"{name} (from {source}): {e}") from None
+        for low, high in CONFIG_RANGES:
+            if values[low] > values[high]:
+                raise ValueError(f"{low} must not be greater than {high}")
+        return values
+
+    def update_source(self, source, settings):
+        """Replaces the settings of one source and applies the result; returns False if it was rejected."""
+        unknown = sorted(name for name in settings if name not in self.schema and name not in self.IGNORED_KEYS)
+        if unknown:
+            logger.warning("Ignoring unknown settings from %s: %s", source, ", ".join(unknown))
+        previous = self.sources.get(source)
+        self.sources[source] = settings
+        try:
+            values = self.merge()
+        except ValueError as e:
+            logger.error("Rejected configuration from %s: %s", source, e)
+            self.restore_source(source, previous)
+            return False
+        if not self.apply(values):
+            self.restore_source(source, previous)
+            return False
+        return True
+
+    def restore_source(self, source, previous):
+        if previous is None:
+            del self.sources[source]
+        else:
+            self.sources[source] = previous
+
+    def apply(self, values):
+        """Assigns the changed settings and calls their subscribers; returns False if a subscriber rejected them."""
+        changes = {name: value for name, value in values.items() if value != self.values[name]}
+        if self.loaded:
+            pending = [name for name in STARTUP_SETTINGS if name in changes]
+            if pending:
+                logger.warning("Changes to %s take effect after the component restarts", ", ".join(pending))
+                for name in pending:
+                    del changes[name]
+        if not changes:
+            return True
+        previous = {name: self.values[name] for name in changes}
+        self.values.update(changes)
+        self.namespace.update(changes)
+        called = []
+        for names, callback in self.subscribers:
+            relevant = {name: changes[name] for name in names if name in changes}
+            if relevant:
+                called.append((names, callback))
+                try:
+                    callback(relevant)
+                except Exception as e:
+                    logger.error("Rejected configuration: error applying %s: %s", ", ".join(relevant), e)
+                    self.rollback(previous, called)
+                    return False
+        logger.info("Configuration changed: %s", ", ".join(sorted(changes)))
+        return True
+
+    def rollback(self, previous, subscribers):
+        """Restores the `previous` values of changed settings and passes them back to the given subscribers."""
+        self.values.update(previous)
+        self.namespace.update(previous)
+        for names, callback in subscribers:
+            relevant = {name: previous[name] for name in names if name in previous}
+            try:
+                callback(relevant)
             except Exception as e:
-                print(f"Failed to collect data from {device_name} ({device_address}): {e}")
-            finally:
-                print(f"Finished processing {device_name} ({device_address}).")
+                logger.error("Error restoring %s: %s", ", ".join(relevant), e)
 
+    def load_file(self):
+        """(Re)loads CONFIG_FILE if it changed since the last call; removing the file reverts its settings."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self.file_mtime is not None:
+                logger.info("%s removed, reverting its settings", self.path)
+                self.file_mtime = None
+                self.update_source("file", {})
+            return
+        if mtime == self.file_mtime:
+            return
+        self.file_mtime = mtime
+        try:
+            with open(self.path, "rb") as config_file:
+                if self.path.endswith(".json"):
+                    settings = json.load(config_file)
+                elif tomllib is None:
+                    raise ValueError("TOML configuration files need Python 3.11 or later")
+                else:
+                    settings = tomllib.load(config_file)
+            if not isinstance(settings, dict):
+                raise ValueError("expected a table of settings")
+        except (OSError, ValueError) as e:
+            logger.error("Could not load %s: %s", self.path, e)
+            return
+        logger.info("Loaded configuration from %s", self.path)
+        self.update_source("file", settings)
 
-async def main():
-    mqtt_publisher = MqttPublisher(DEVICE_CERT, DEVICE_KEY, ROOT_CA, ENDPOINT)
-    mqtt_publisher.setup_mqtt_client()
+    def load_component_config(self):
+        """Loads the component configuration over Greengrass IPC and subscribes to its updates, if available."""
+        if GreengrassCoreIPCClientV2 is None or "AWS_GG_NUCLEUS_DOMAIN_SOCKET_FILEPATH_FOR_COMPONENT" not in os.environ:
+            return
+        try:
+            self.ipc_client = GreengrassCoreIPCClientV2()
+            self.update_source("component", self.ipc_client.get_configuration(key_path=[]).value or {})
+            self.ipc_client.subscribe_to_configuration_update(key_path=[], on_stream_event=self.on_component_update)
+        except Exception as e:
+            logger.warning("Component configuration not available over Greengrass IPC: %s", e)
 
-    # # Create the SensorGateway instance
-    bt_sensor = SensorGateway(STMICROELECTRONICS_MANUFACTURER_KEY, SERVICE_UUID, CHARACTERISTIC_UUIDS, mqtt_publisher)
+    def on_component_update(self, event):
+        """IPC stream handler (runs on an IPC thread): fetches the new component configuration."""
+        try:
+            settings = self.ipc_client.get_configuration(key_path=[]).value or {}
+        except Exception as e:
+            logger.error("Error reading the updated component configuration: %s", e)
+            return
+        self.loop.call_soon_threadsafe(self.update_source, "component", settings)
+
+    def load(self):
+        """Loads all sources; called once at startup, before the gateway is built from the constants."""
+        self.loop = asyncio.get_event_loop()
+        self.load_component_config()
+        self.load_file()
+        self.loaded = True
+
+    async def watch(self, period=None):
+        """Reloads CONFIG_FILE when it changes, checking every `period` (CONFIG_POLL_INTERVAL) seconds. Runs until cancelled."""
+        while True:
+            await asyncio.sleep(period or CONFIG_POLL_INTERVAL)
+            self.load_file()
+
+
+def setup_logging(name=None):
+    """Configures leveled, rate-limited logging to stdout (captured by Greengrass)."""
+    handler = logging.StreamHandler()
+    prefix = f"[{name}] " if name else ""
+    handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s {prefix}%(message)s"))
+    handler.addFilter(RateLimitFilter())
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+LOGGING_SETTINGS = ("LOG_LEVEL", "LOG_RATE_LIMIT", "LOG_RATE_INTERVAL")
+
+
+def configure_logging(changes):
+    """Applies changed logging settings (see ConfigManager)."""
+    logger.setLevel(LOG_LEVEL)
+    for handler in logger.handlers:
+        for log_filter in handler.filters:
+            if isinstance(log_filter, RateLimitFilter):
+                log_filter.limit = LOG_RATE_LIMIT
+                log_filter.interval = LOG_RATE_INTERVAL
+
+
+def load_config():
+    """Loads the runtime configuration (see ConfigManager) and applies its logging settings."""
+    config = ConfigManager()
+    config.subscribe(LOGGING_SETTINGS, configure_logging)
+    config.load()
+    return config
+
+
+async def wait_for_stop(stop, timeout):
+    """Sleeps for `timeout` seconds, returning early with True if the `stop` event (may be None) is set."""
+    if stop is None:
+        await asyncio.sleep(timeout)
+        return False
+    waiter = asyncio.ensure_future(stop.wait())
+    try:
+        await asyncio.wait((waiter,), timeout=timeout)
+    finally:
+        waiter.cancel()
+    return stop.is_set()
+
+
+def stop_on_sigterm():
+    """Returns an asyncio.Event set when the process receives SIGTERM (e.g. when Greengrass stops the component)."""
+    stop = asyncio.Event()
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    return stop
+
+
+class MetricsService:
+    """
+    Local metrics endpoint and periodic metrics report of the main process, or of worker `shard`
+    in sharded mode, as configured by the METRICS_* settings; restarted when they change.
+    `routes` adds further handlers to the endpoint (e.g. the reading history's query API).
+    """
+    SETTINGS = ("METRICS_HOST", "METRICS_PORT", "METRICS_TOPIC", "METRICS_INTERVAL")
+
+    def __init__(self, publisher, shard=None, routes=None):
+        self.publisher = publisher
+        self.shard = shard
+        self.routes = routes or {}
+        self.http_server = None
+        self.metrics_task = None
+        self.restart_task = None
+
+    async def start(self):
+        port, topic = METRICS_PORT, METRICS_TOPIC
+        if self.shard is not None:
+            port, topic = (METRICS_PORT + self.shard + 1 if METRICS_PORT else 0), f"{METRICS_TOPIC}/worker{self.shard}"
+        if port:
+            self.http_server = LocalHttpServer(METRICS_HOST, port)
+            self.http_server.add_route("/metrics", lambda query: (200, "text/plain; version=0.0.4", METRICS.render()))
+            for path, handler in self.routes.items():
+                self.http_server.add_route(path, handler)
+            try:
+                await self.http_server.start()
+            except OSError as e:
+                logger.error("Could not start the metrics endpoint on %s:%d: %s", METRICS_HOST, port, e)
+                self.http_server = None
+        if METRICS_INTERVAL:
+            self.metrics_task = asyncio.create_task(MetricsReporter(self.publisher, topic, METRICS_INTERVAL).run())
+
+    async def stop(self):
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            await asyncio.gather(self.metrics_task, return_exceptions=True)
+            self.metrics_task = None
+        if self.http_server is not None:
+            await self.http_server.stop()
+            self.http_server = None
+
+    async def restart(self):
+        await self.stop()
+        await self.start()
+
+    def reconfigure(self, changes):
+        """Restarts the endpoint and report with the changed settings (see ConfigManager)."""
+        self.restart_task = asyncio.create_task(self.restart())
+
+
+async def run_gateway(bt_sensor, mqtt_publisher, runtime=RUNTIME, stop=None, config=None):
+    """
+    Runs the gateway's background tasks and collection loop for `runtime` seconds, or until the
+    `stop` event is set, then shuts down cleanly. With a ConfigManager, configuration changes are
+    applied while running.
+    """
+    await bt_sensor.setup_bluetooth()
 
     # Start MQTT loop in the background
     mqtt_publisher.start()
+    publish_task = asyncio.create_task(bt_sensor.publish_pipeline.run())
+    processing_task = asyncio.create_task(bt_sensor.stream_processor.run())
+    alert_task = asyncio.create_task(bt_sensor.alert_engine.run())
+    drain_task = asyncio.create_task(mqtt_publisher.drain())
+
+    # Metrics: gauges read live state, exposed locally over HTTP and/or published periodically
+    METRICS.gauge("publish_queue_depth", "Readings waiting in the publish queue", bt_sensor.publish_pipeline.queue.qsize)
+    METRICS.gauge("ble_connected_devices", "Devices with an established connection", lambda: len(bt_sensor.session_engine.connected))
+    METRICS.gauge("ble_registered_devices", "Devices in the registry", lambda: len(bt_sensor.registry.entries))
+    if mqtt_publisher.buffer is not None:
+        METRICS.gauge("store_and_forward_bytes", "Size of the store-and-forward buffer", lambda: sum(mqtt_publisher.buffer.sizes.values()))
+    metrics = MetricsService(mqtt_publisher, bt_sensor.registry.shard[0] if bt_sensor.registry.shard else None,
+                             bt_sensor.history.routes() if bt_sensor.history is not None else None)
+    await metrics.start()
+
+    # Keep the device registry, and the device objects BlueZ has under each adapter, up to date in the background
+    scanner_task = asyncio.create_task(bt_sensor.run_scanner())
+    bluez_task = asyncio.create_task(bt_sensor.refresh_bluez_devices())
+    poll_task = None
+    if PERSISTENT_CONNECTIONS:
+        # Stream from devices as soon as they are registered
+        bt_sensor.registry.add_listener(bt_sensor.session_engine.on_registry_event)
+    else:
+        # Poll registered devices, each on its own adaptive schedule
+        bt_sensor.registry.add_listener(bt_sensor.poll_scheduler.on_registry_event)
+        poll_task = asyncio.create_task(bt_sensor.poll_scheduler.run())
+
+    # Sessions with the devices of the last snapshot start now, in parallel with discovery
+    snapshot_task = None
+    if SNAPSHOT_INTERVAL:
+        snapshot_path = SNAPSHOT_FILE
+        if bt_sensor.registry.shard:
+            root, extension = os.path.splitext(SNAPSHOT_FILE)
+            snapshot_path = f"{root}.worker{bt_sensor.registry.shard[0]}{extension}"
+        snapshot = GatewaySnapshot(bt_sensor, snapshot_path)
+        snapshot.restore()
+        snapshot_task = asyncio.create_task(snapshot.run())
+
+    config_task = None
+    if config is not None:
+        def restart_scanner(changes):
+            nonlocal scanner_task
+            scanner_task = asyncio.create_task(bt_sensor.restart_scanner(scanner_task))
+
+        config.subscribe(bt_sensor.SETTINGS, bt_sensor.reconfigure)
+        config.subscribe(PublishPipeline.SETTINGS, bt_sensor.publish_pipeline.reconfigure)
+        config.subscribe(AlertEngine.SETTINGS, bt_sensor.alert_engine.reconfigure)
+        config.subscribe(("SCANNING_MODE", "STMICROELECTRONICS_MANUFACTURER_KEY"), restart_scanner)
+        config.subscribe(MetricsService.SETTINGS, metrics.reconfigure)
+        if mqtt_publisher.SETTINGS:
+            config.subscribe(mqtt_publisher.SETTINGS, mqtt_publisher.reconfigure)
+        config_task = asyncio.create_task(config.watch())
+
+    stop_time = asyncio.get_event_loop().time() + runtime
+    while asyncio.get_event_loop().time() < stop_time and not (stop is not None and stop.is_set()):
+        remaining = stop_time - asyncio.get_event_loop().time()
+        if not bt_sensor.devices:
+            logger.info("No devices found yet. Waiting for advertisements...")
+            await wait_for_stop(stop, min(5, remaining))
+            continue
+
+        # Sessions are started by the registry listener (streaming) or the poll scheduler; just report periodically
+        await wait_for_stop(stop, min(SCAN_INTERVAL, remaining))
+        bt_sensor.session_engine.log_sample_rates()
+
+    if config_task is not None:
+        config_task.cancel()
+        await asyncio.gather(config_task, return_exceptions=True)
+    scanner_task.cancel()
+    await asyncio.gather(scanner_task, return_exceptions=True)
+    bluez_task.cancel()
+    await asyncio.gather(bluez_task, return_exceptions=True)
+    if snapshot_task is not None:
+        snapshot_task.cancel()
+        await asyncio.gather(snapshot_task, return_exceptions=True)
+    if metrics.restart_task is not None:
+        await asyncio.gather(metrics.restart_task, return_exceptions=True)
+    await metrics.stop()
+    if poll_task is not None:
+        poll_task.cancel()
+        await asyncio.gather(poll_task, return_exceptions=True)
+    await bt_sensor.session_engine.stop_streaming()
+    if bt_sensor.history is not None:
+        bt_sensor.history.close()
+    processing_task.cancel()
+    await asyncio.gather(processing_task, return_exceptions=True)
+    alert_task.cancel()
+    await asyncio.gather(alert_task, return_exceptions=True)
+    publish_task.cancel()
+    await asyncio.gather(publish_task, return_exceptions=True)
+    drain_task.cancel()
+    await asyncio.gather(drain_task, return_exceptions=True)
+    await mqtt_publisher.stop()
+    logger.info("Finished collecting data from BLE devices.")
+
+
+def run_worker(shard, shards, messages):
+    """Entry point of worker process `shard` in sharded mode (see WORKER_PROCESSES)."""
+    setup_logging(f"worker{shard}")
+    asyncio.run(worker_main(shard, shards, messages))
+
+
+async def worker_main(shard, shards, messages):
+    config = load_config()
+    publisher = QueuePublisher(messages)
+    bt_sensor = SensorGateway(STMICROELECTRONICS_MANUFACTURER_KEY, SERVICE_UUID, CHARACTERISTIC_UUIDS, publisher,
+                              max_connections=max(1, MAX_CONNECTIONS // shards), shard=(shard, shards))
+    await run_gateway(bt_sensor, publisher, runtime=RUNTIME, stop=stop_on_sigterm(), config=config)
+
+
+async def run_sharded(supervisor, mqtt_publisher, runtime=RUNTIME, stop=None, config=None):
+    """
+    Publishing side of sharded mode: runs the worker processes under `supervisor` and publishes
+    their messages for `runtime` seconds, or until the `stop` event is set, then shuts down cleanly.
+    Workers load and watch the configuration themselves; this process applies the publisher and metrics settings.
+    """
+    mqtt_publisher.start()
+    drain_task = asyncio.create_task(mqtt_publisher.drain())
+    if mqtt_publisher.buffer is not None:
+        METRICS.gauge("store_and_forward_bytes", "Size of the store-and-forward buffer", lambda: sum(mqtt_publisher.buffer.sizes.values()))
+    METRICS.gauge("worker_processes_alive", "Worker processes currently running", supervisor.alive)
+    metrics = MetricsService(mqtt_publisher)
+    await metrics.start()
+    config_task = None
+    if config is not None:
+        config.subscribe(MetricsService.SETTINGS, metrics.reconfigure)
+        config.subscribe(mqtt_publisher.SETTINGS, mqtt_publisher.reconfigure)
+        config_task = asyncio.create_task(config.watch())
+
+    supervisor.start()
+    supervise_task = asyncio.create_task(supervisor.supervise())
+    forward_task = asyncio.create_task(supervisor.forward(mqtt_publisher))
+    await wait_for_stop(stop, runtime)
+
+    # Workers flush their pending batches on SIGTERM; keep forwarding until they are gone
+    supervise_task.cancel()
+    await asyncio.gather(supervise_task, return_exceptions=True)
+    await supervisor.stop()
+    await forward_task
+    if config_task is not None:
+        config_task.cancel()
+        await asyncio.gather(config_task, return_exceptions=True)
+    if metrics.restart_task is not None:
+        await asyncio.gather(metrics.restart_task, return_exceptions=True)
+    await metrics.stop()
+    drain_task.cancel()
+    await asyncio.gather(drain_task, return_exceptions=True)
+    await mqtt_publisher.stop()
+    logger.info("Finished collecting data from BLE devices.")
+
+
+def create_publisher():
+    """Creates the publisher selected by PUBLISH_BACKEND."""
+    if PUBLISH_BACKEND == "ipc":
+        return GreengrassIpcPublisher()
+    mqtt_publisher = MqttPublisher(DEVICE_CERT, DEVICE_KEY, ROOT_CA, ENDPOINT)
+    mqtt_publisher.setup_mqtt_client()
+    return mqtt_publisher
 
-    # Periodically scan and read data from devices
-    start_time = asyncio.get_event_loop().time()
-    while asyncio.get_event_loop().time() - start_time < RUNTIME:
-        # Scan for devices and populate the device list
-        await bt_sensor.find_devices()
 
-        if not bt_sensor.devices:
-            print("No devices found. Retrying after a delay...")
-            await asyncio.sleep(5)  # Delay before rescanning
-            continue  
+async def main():
+    setup_logging()
+    config = load_config()
+    mqtt_publisher = create_publisher()
+    stop = stop_on_sigterm()
 
-        # Continuously read temperature data from each discovered device for the duration of scan_interval
-        end_time = asyncio.get_event_loop().time() + SCAN_INTERVAL
-        while asyncio.get_event_loop().time() < end_time:
-            await bt_sensor.read_data_from_all_devices()
+    if WORKER_PROCESSES > 0:
+        await run_sharded(WorkerSupervisor(WORKER_PROCESSES), mqtt_publisher, runtime=RUNTIME, stop=stop, config=config)
+        return
 
-        # Wait before the next scan (just to ensure the logic is followed; the inner loop takes care of timing)
-        await asyncio.sleep(0)
+    # # Create the SensorGateway instance
+    bt_sensor = SensorGateway(STMICROELECTRONICS_MANUFACTURER_KEY, SERVICE_UUID, CHARACTERISTIC_UUIDS, mqtt_publisher, max_connections=MAX_CONNECTIONS)
 
-    print("Finished collecting data from BLE devices.")
+    await run_gateway(bt_sensor, mqtt_publisher, runtime=RUNTIME, stop=stop, config=config)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
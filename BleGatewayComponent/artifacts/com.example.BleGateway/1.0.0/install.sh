@@ -25,6 +25,9 @@ fi
 # Install pip3 if it's not already installed
 apt-get install -y python3-pip
 
-# Install necessary Python packages
-pip3 install bleak>=0.22.3 paho-mqtt>=2.1.0
+# Install necessary Python packages (bleak 3 is needed for the per-connection "bluez" adapter argument)
+pip3 install "bleak>=3.0,<4" "paho-mqtt>=2.1.0"
 echo "Packages bleak and paho-mqtt have been installed."
+
+# Optional: AWS IoT Device SDK, used to read the component configuration over Greengrass IPC
+pip3 install awsiotsdk || echo "awsiotsdk could not be installed; only the local configuration file will be used."
@@ -0,0 +1,402 @@
+"""
+Throughput benchmark for the BLE Gateway component, without Bluetooth hardware or network.
+
+The gateway in BleGateway.py is run unmodified (run_gateway) against:
+  - simulated PROTEUS peripherals: stand-ins for BleakScanner and BleakClient that advertise the
+    ST manufacturer ID and emit PROTEUS-format notifications at a configurable rate, and
+  - a local broker stand-in in place of the paho client, which acknowledges QoS 1 messages after
+    a configurable delay and decodes every payload it receives, or with --backend ipc a local
+    stand-in for the Greengrass IPC transport that does the same.
+
+It reports end-to-end readings/s, p50/p99 latency from notification to broker, CPU time and RSS.
+Results can be saved as a JSON baseline and compared against a previous one to catch regressions
+between releases.
+
+Requires the component's Python dependencies (bleak, paho-mqtt) to be installed; no Bluetooth
+adapter, D-Bus connection or network access is used.
+
+Usage:
+    python3 tools/benchmark.py --devices 20 --rate 10 --duration 30 --save baseline.json
+    python3 tools/benchmark.py --devices 20 --rate 10 --duration 30 --compare baseline.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import platform
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ARTIFACT_DIR = os.path.join(TOOLS_DIR, os.pardir, "BleGatewayComponent", "artifacts", "com.example.BleGateway", "1.0.0")
+sys.path.insert(0, ARTIFACT_DIR)
+sys.path.insert(0, TOOLS_DIR)
+
+import BleGateway  # noqa: E402
+from payload_decoder import decode_payload  # noqa: E402
+
+import paho.mqtt.client as paho  # noqa: E402
+
+
+# Notification payload builders per characteristic: (timestamp, sequence number) -> bytes
+PAYLOAD_BUILDERS = {
+    "TEMPERATURE": lambda timestamp, seq: struct.pack("<HH", timestamp, 200 + seq % 100),
+    "BATTERY": lambda timestamp, seq: struct.pack("<HHHHB", timestamp, 1000 - seq % 1000, 3700 + seq % 500, seq % 100, 1),
+    "ACCELEROMETER_EVENT": lambda timestamp, seq: struct.pack("<HBH", timestamp, 1 << (seq % 8), seq % 65536),
+    "SWITCH": lambda timestamp, seq: struct.pack("<HB", timestamp, seq % 2),
+}
+
+
+class Stats:
+    """Shared counters between the simulated devices and the broker stand-in."""
+    def __init__(self):
+        self.sent = {}  # (address, stream, timestamp) -> send time of the notification
+        self.notifications = 0
+        self.messages = 0
+        self.readings = 0
+        self.payload_bytes = 0
+        self.latencies = []
+
+    def record(self, topic, payload, received):
+        """Counts a message received by a stand-in and the latency of each of its timestamped readings."""
+        self.messages += 1
+        self.payload_bytes += len(payload)
+        if topic == BleGateway.METRICS_TOPIC:
+            return
+        document = decode_payload(payload)
+        stream = topic.rsplit("/", 2)[-2]  # Topics are {device_name}/{stream}/{device_address}
+        for reading in document.get("readings", ()):
+            self.readings += 1
+            sent = self.sent.get((document["address"], stream, reading.get("timestamp")))
+            if sent is not None:
+                self.latencies.append(received - sent)
+
+
+class SimulatedAdvertisement:
+    def __init__(self, manufacturer_id, name, rssi):
+        self.manufacturer_data = {manufacturer_id: b"\x00\x00"}
+        self.local_name = name
+        self.rssi = rssi
+        self.service_uuids = [BleGateway.SERVICE_UUID]
+
+
+class SimulatedDevice:
+    """BLEDevice stand-in."""
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+
+
+class SimulatedCharacteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class SimulatedServices:
+    def get_characteristic(self, uuid):
+        return SimulatedCharacteristic(uuid)
+
+
+def make_scanner_class(devices, manufacturer_id):
+    """Builds a BleakScanner stand-in that keeps advertising `devices` once a second."""
+    class SimulatedScanner:
+        def __init__(self, detection_callback=None, **kwargs):
+            self.detection_callback = detection_callback
+            self.task = None
+
+        @staticmethod
+        async def discover(return_adv=False, **kwargs):
+            return {device.address: (device, SimulatedAdvertisement(manufacturer_id, device.name, -60)) for device in devices}
+
+        async def advertise(self):
+            while True:
+                for device in devices:
+                    self.detection_callback(device, SimulatedAdvertisement(manufacturer_id, device.name, -60))
+                await asyncio.sleep(1)
+
+        async def start(self):
+            self.task = asyncio.create_task(self.advertise())
+
+        async def stop(self):
+            self.task.cancel()
+
+    return SimulatedScanner
+
+
+def make_client_class(stats, rate, connect_delay):
+    """Builds a BleakClient stand-in whose subscriptions emit notifications at `rate` per second."""
+    names = {uuid: name for name, uuid in BleGateway.CHARACTERISTIC_UUIDS.items()}
+
+    class SimulatedClient:
+        def __init__(self, address_or_device, disconnected_callback=None, services=None, **kwargs):
+            self.address = getattr(address_or_device, "address", address_or_device)
+            self.is_connected = False
+            self.services = SimulatedServices()
+            self.tasks = {}
+
+        async def __aenter__(self):
+            await asyncio.sleep(connect_delay)
+            self.is_connected = True
+            return self
+
+        async def __aexit__(self, *exc_info):
+            for task in self.tasks.values():
+                task.cancel()
+            self.is_connected = False
+
+        async def emit(self, uuid, callback):
+            build = PAYLOAD_BUILDERS[names[uuid]]
+            stream = BleGateway.CHARACTERISTIC_DECODERS[names[uuid]].stream
+            sender = SimulatedCharacteristic(uuid)
+            loop = asyncio.get_event_loop()
+            period = 1 / rate
+            next_time = loop.time()
+            seq = 0
+            while True:
+                timestamp = seq % 65536
+                stats.sent[(self.address, stream, timestamp)] = time.perf_counter()
+                stats.notifications += 1
+                result = callback(sender, bytearray(build(timestamp, seq)))
+                if asyncio.iscoroutine(result):
+                    # bleak schedules coroutine callbacks as tasks
+                    asyncio.ensure_future(result)
+                seq += 1
+                next_time += period
+                await asyncio.sleep(max(0, next_time - loop.time()))
+
+        async def start_notify(self, uuid, callback):
+            self.tasks[uuid] = asyncio.create_task(self.emit(uuid, callback))
+
+        async def stop_notify(self, uuid):
+            task = self.tasks.pop(uuid, None)
+            if task is not None:
+                task.cancel()
+
+    return SimulatedClient
+
+
+class MessageInfo:
+    """paho MQTTMessageInfo stand-in."""
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = paho.MQTT_ERR_SUCCESS
+        self.published = False
+
+    def is_published(self):
+        return self.published
+
+
+class LocalBroker:
+    """
+    Broker stand-in used in place of MqttPublisher's paho client.
+
+    Every published payload is decoded with the reference decoder to count readings and measure
+    the latency of each timestamped reading; QoS 1 acknowledgements are delivered to the
+    publisher's on_publish callback after `ack_delay` seconds.
+    """
+    def __init__(self, stats, publisher, ack_delay):
+        self.stats = stats
+        self.publisher = publisher
+        self.ack_delay = ack_delay
+        self.mid = 0
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def acknowledge(self, info):
+        info.published = True
+        self.publisher.on_publish(self, None, info.mid, None, None)
+
+    def publish(self, topic, payload, qos=0):
+        received = time.perf_counter()
+        self.mid += 1
+        info = MessageInfo(self.mid)
+        self.stats.record(topic, payload, received)
+        asyncio.get_event_loop().call_later(self.ack_delay, self.acknowledge, info)
+        return info
+
+
+class LocalIpcTransport:
+    """
+    Greengrass IPC transport stand-in used in place of GreengrassIpcTransport.
+
+    Payloads are decoded like LocalBroker does; the returned futures complete after `ack_delay`
+    seconds, as when the nucleus accepts a message.
+    """
+    def __init__(self, stats, ack_delay):
+        self.stats = stats
+        self.ack_delay = ack_delay
+
+    def publish(self, topic, payload):
+        self.stats.record(topic, payload, time.perf_counter())
+        future = concurrent.futures.Future()
+        asyncio.get_event_loop().call_later(self.ack_delay, future.set_result, None)
+        return future
+
+    publish_to_iot_core = publish
+    publish_to_topic = publish
+
+
+class BenchmarkGateway(BleGateway.SensorGateway):
+    """SensorGateway that skips host Bluetooth adapter setup."""
+    async def setup_bluetooth(self):
+        pass
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return None
+
+
+async def run_benchmark(args):
+    stats = Stats()
+    devices = [SimulatedDevice(f"02:00:00:00:{index // 256:02X}:{index % 256:02X}", f"PROTEUS{index}") for index in range(args.devices)]
+    characteristics = {name: BleGateway.CHARACTERISTIC_UUIDS[name] for name in args.characteristics}
+
+    # Gateway configuration for the run
+    BleGateway.BleakScanner = make_scanner_class(devices, BleGateway.STMICROELECTRONICS_MANUFACTURER_KEY)
+    BleGateway.BleakClient = make_client_class(stats, args.rate, args.connect_delay)
+    BleGateway.PERSISTENT_CONNECTIONS = True
+    BleGateway.METRICS_PORT = 0
+    BleGateway.METRICS_INTERVAL = 0
+    BleGateway.SNAPSHOT_INTERVAL = 0
+    BleGateway.BLUEZ_REFRESH_INTERVAL = 0
+    BleGateway.STREAM_PROCESSING = {} if args.raw else BleGateway.STREAM_PROCESSING
+    BleGateway.logger.setLevel(args.log_level)
+
+    with tempfile.TemporaryDirectory(prefix="ble-benchmark-") as buffer_dir:
+        if args.backend == "ipc":
+            publisher = BleGateway.GreengrassIpcPublisher(LocalIpcTransport(stats, args.ack_delay))
+        else:
+            publisher = BleGateway.MqttPublisher("cert", "key", "ca", "localhost", buffer=BleGateway.StoreAndForwardBuffer(buffer_dir))
+            publisher.client = LocalBroker(stats, publisher, args.ack_delay)
+            publisher.connected.set()
+
+        pipeline = BleGateway.PublishPipeline(publisher, batch_size=args.batch_size, flush_interval=args.flush_interval,
+                                              encoder=BleGateway.PayloadEncoder(args.payload_format))
+        gateway = BenchmarkGateway(BleGateway.STMICROELECTRONICS_MANUFACTURER_KEY, BleGateway.SERVICE_UUID, characteristics,
+                                   publisher, max_connections=args.max_connections, publish_pipeline=pipeline,
+                                   adapters=[f"hci{index}" for index in range(args.adapters)])
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        await BleGateway.run_gateway(gateway, publisher, runtime=args.duration)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+    return {
+        "config": {
+            "devices": args.devices,
+            "rate": args.rate,
+            "characteristics": args.characteristics,
+            "duration": args.duration,
+            "max_connections": args.max_connections,
+            "adapters": args.adapters,
+            "batch_size": args.batch_size,
+            "flush_interval": args.flush_interval,
+            "payload_format": args.payload_format,
+            "backend": args.backend,
+            "raw": args.raw,
+        },
+        "environment": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "results": {
+            "notifications_per_second": stats.notifications / wall,
+            "readings_per_second": stats.readings / wall,
+            "messages_per_second": stats.messages / wall,
+            "bytes_per_reading": stats.payload_bytes / stats.readings if stats.readings else None,
+            "latency_p50_ms": percentile(stats.latencies, 0.5) * 1000 if stats.latencies else None,
+            "latency_p99_ms": percentile(stats.latencies, 0.99) * 1000 if stats.latencies else None,
+            "cpu_percent": 100 * cpu / wall,
+            "cpu_us_per_notification": 1e6 * cpu / stats.notifications if stats.notifications else None,
+            "rss_kb": current_rss_kb(),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "readings_dropped": pipeline.dropped,
+        },
+    }
+
+
+# Direction of improvement per result, used when comparing against a baseline
+HIGHER_IS_BETTER = {"notifications_per_second", "readings_per_second"}
+LOWER_IS_BETTER = {"bytes_per_reading", "latency_p50_ms", "latency_p99_ms", "cpu_percent", "cpu_us_per_notification", "max_rss_kb"}
+
+
+def compare(results, baseline, tolerance):
+    """Prints the relative change of each result against the baseline and returns the regressed keys."""
+    regressions = []
+    print(f"\n{'metric':<28}{'baseline':>14}{'current':>14}{'change':>10}")
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        regressed = (key in HIGHER_IS_BETTER and change < -tolerance) or (key in LOWER_IS_BETTER and change > tolerance)
+        if regressed:
+            regressions.append(key)
+        print(f"{key:<28}{previous:>14.2f}{current:>14.2f}{change:>+9.1%}{' !' if regressed else ''}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=10, help="number of simulated PROTEUS nodes")
+    parser.add_argument("--rate", type=float, default=10, help="notifications per second per characteristic and device")
+    parser.add_argument("--characteristics", nargs="+", default=["TEMPERATURE", "BATTERY"], choices=sorted(PAYLOAD_BUILDERS),
+                        help="characteristics each node notifies on")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run")
+    parser.add_argument("--max-connections", type=int, default=BleGateway.MAX_CONNECTIONS, help="connections per adapter")
+    parser.add_argument("--adapters", type=int, default=1, help="number of simulated HCI adapters")
+    parser.add_argument("--batch-size", type=int, default=BleGateway.PUBLISH_BATCH_SIZE)
+    parser.add_argument("--flush-interval", type=float, default=BleGateway.PUBLISH_FLUSH_INTERVAL)
+    parser.add_argument("--payload-format", default=BleGateway.PAYLOAD_FORMAT, choices=["json", "packed", "msgpack", "cbor"])
+    parser.add_argument("--backend", default="mqtt", choices=["mqtt", "ipc"], help="publishing backend (PUBLISH_BACKEND)")
+    parser.add_argument("--raw", action="store_true", help="disable STREAM_PROCESSING rules")
+    parser.add_argument("--connect-delay", type=float, default=0.5, help="simulated connection time in seconds")
+    parser.add_argument("--ack-delay", type=float, default=0.05, help="simulated broker or nucleus acknowledgement delay in seconds")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change treated as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    BleGateway.setup_logging()
+    report = asyncio.run(run_benchmark(args))
+
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config") != report["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
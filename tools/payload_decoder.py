@@ -0,0 +1,123 @@
+"""
+Reference decoder for the MQTT payloads published by the BLE Gateway component.
+
+Every payload format selectable with PAYLOAD_FORMAT in BleGateway.py decodes to the same
+document as the "json" format:
+
+    {"device": ..., "address": ..., "readings": [{field: value, ...}, ...]}
+
+The module has no dependencies beyond the standard library for the "json" and "packed"
+formats, so it can be dropped into a cloud-side consumer (e.g. an AWS Lambda function).
+The "msgpack" and "cbor" formats need the msgpack and cbor2 packages respectively.
+
+Usage:
+    python3 payload_decoder.py payload.bin [payload2.bin ...]
+    python3 payload_decoder.py < payload.bin
+"""
+import json
+import math
+import struct
+import sys
+
+MAGIC = b"BG"
+HEADER = struct.Struct("<2sBB")  # magic, version, format id
+SUPPORTED_VERSIONS = (1,)
+FORMAT_MSGPACK = 1
+FORMAT_CBOR = 2
+FORMAT_PACKED = 3
+
+
+def read_string(payload, offset):
+    """Reads a length-prefixed (uint8) UTF-8 string and returns (text, new_offset)."""
+    length = payload[offset]
+    offset += 1
+    return payload[offset:offset + length].decode(), offset + length
+
+
+def unpack_columns(payload, offset):
+    """Decodes the body of a "packed" payload starting at `offset`."""
+    device, offset = read_string(payload, offset)
+    address, offset = read_string(payload, offset)
+    count, field_count = struct.unpack_from("<HB", payload, offset)
+    offset += 3
+
+    readings = [{} for _ in range(count)]
+    for _ in range(field_count):
+        field, offset = read_string(payload, offset)
+        code = chr(payload[offset])
+        offset += 1
+        rows = range(count)
+        if code == "?":
+            # Nullable column: bitmap of the readings that have a value, then the column of those values
+            bitmap = payload[offset:offset + (count + 7) // 8]
+            offset += len(bitmap)
+            rows = [row for row in rows if bitmap[row // 8] >> (row % 8) & 1]
+            code = chr(payload[offset])
+            offset += 1
+        if code in "sS":
+            if code == "s":
+                label_count, index_code = payload[offset], "B"
+                offset += 1
+            else:
+                (label_count,), index_code = struct.unpack_from("<H", payload, offset), "H"
+                offset += 2
+            labels = []
+            for _ in range(label_count):
+                label, offset = read_string(payload, offset)
+                labels.append(label)
+            column = struct.Struct(f"<{len(rows)}{index_code}")
+            values = [labels[index] for index in column.unpack_from(payload, offset)]
+            offset += column.size
+        elif code in "bhiqd":
+            column = struct.Struct(f"<{len(rows)}{code}")
+            values = column.unpack_from(payload, offset)
+            offset += column.size
+        else:
+            raise ValueError(f"Unknown column type {code!r} for field {field!r}")
+
+        for row, value in zip(rows, values):
+            # Missing values are left out of nullable columns, or encoded as NaN (floats) or "" (strings)
+            if value == "" or (isinstance(value, float) and math.isnan(value)):
+                continue
+            readings[row][field] = value
+
+    return {"device": device, "address": address, "readings": readings}
+
+
+def decode_payload(payload):
+    """
+    Decodes one MQTT payload published by the gateway.
+
+    Args:
+        payload (bytes | str): The raw MQTT message payload.
+
+    Returns:
+        dict: {"device": str, "address": str, "readings": list of dicts}
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if not payload.startswith(MAGIC):
+        return json.loads(payload)
+
+    magic, version, format_id = HEADER.unpack_from(payload)
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported payload version {version}")
+    body = payload[HEADER.size:]
+    if format_id == FORMAT_PACKED:
+        return unpack_columns(payload, HEADER.size)
+    if format_id == FORMAT_MSGPACK:
+        import msgpack
+        return msgpack.unpackb(body)
+    if format_id == FORMAT_CBOR:
+        import cbor2
+        return cbor2.loads(body)
+    raise ValueError(f"Unknown payload format id {format_id}")
+
+
+if __name__ == "__main__":
+    sources = sys.argv[1:]
+    if not sources:
+        print(json.dumps(decode_payload(sys.stdin.buffer.read()), indent=2))
+    for path in sources:
+        with open(path, "rb") as payload_file:
+            print(json.dumps(decode_payload(payload_file.read()), indent=2))